@@ -0,0 +1,106 @@
+import math
+import os
+import threading
+import time
+from collections import deque
+
+
+class AimdController:
+    """Additive-increase / multiplicative-decrease limit for in-flight CPI requests.
+
+    Every healthy response grows the limit by roughly one per round of
+    `limit` responses. A 429 or 5xx, or a p95 latency that rises above
+    `latency_tolerance` times the baseline of the same endpoint, multiplies
+    it by `decrease`. The baseline is a moving average of the p95 over about
+    one `latency_window` of responses, so one lucky window does not set the
+    bar. Baselines are tracked per endpoint, so slow but healthy downloads
+    are not compared with fast listings, and are dropped after every decrease
+    so they reflect the current limit. Decreases are spaced at least
+    `cooldown` seconds apart so one burst of throttling only counts once.
+    Thread-safe, so async and threaded callers can feed it alike.
+    """
+
+    def __init__(self, initial=4, min_limit=1, max_limit=32, decrease=0.5,
+                 latency_window=50, latency_tolerance=2.0, cooldown=1.0):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.decrease = decrease
+        self.latency_tolerance = latency_tolerance
+        self.cooldown = cooldown
+        self.peak = self.lowest = self._limit = float(max(min_limit, min(initial, max_limit)))
+        self.latency_window = latency_window
+        self._latencies = {}
+        self._baseline_p95 = {}
+        self._last_decrease = 0.0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls, max_limit):
+        return cls(
+            initial=int(os.environ.get("CONCURRENCY_INITIAL", "4")),
+            min_limit=int(os.environ.get("CONCURRENCY_MIN", "1")),
+            max_limit=max_limit,
+            latency_tolerance=float(os.environ.get("CONCURRENCY_LATENCY_TOLERANCE", "2.0"))
+        )
+
+    @property
+    def limit(self):
+        return int(self._limit)
+
+    def record(self, latency, failed, endpoint=None):
+        """Feeds back the outcome of one request to `endpoint`."""
+        with self._lock:
+            if failed:
+                self._back_off("throttled or failed request")
+                return
+            latencies = self._latencies.setdefault(endpoint, deque(maxlen=self.latency_window))
+            latencies.append(latency)
+            if len(latencies) == latencies.maxlen:
+                p95 = self._p95(latencies)
+                baseline = self._baseline_p95.get(endpoint)
+                if baseline is not None and p95 > baseline * self.latency_tolerance:
+                    self._back_off(f"{endpoint or 'request'} p95 latency {p95 * 1000:.0f}ms")
+                    return
+                self._baseline_p95[endpoint] = p95 if baseline is None else baseline + (p95 - baseline) / self.latency_window
+            self._limit = min(self.max_limit, self._limit + 1 / self._limit)
+            self.peak = max(self.peak, self._limit)
+
+    def _p95(self, latencies):
+        ordered = sorted(latencies)
+        return ordered[max(math.ceil(len(ordered) * 0.95) - 1, 0)]
+
+    def _back_off(self, reason):
+        now = time.monotonic()
+        if now - self._last_decrease < self.cooldown:
+            return
+        self._last_decrease = now
+        previous = self.limit
+        self._limit = max(self.min_limit, self._limit * self.decrease)
+        self.lowest = min(self.lowest, self._limit)
+        self._latencies.clear()
+        self._baseline_p95.clear()
+        if self.limit != previous:
+            print(f"concurrency limit {previous} -> {self.limit} ({reason})")
+
+    def summary(self):
+        return f"concurrency limit: {self.limit} (lowest {int(self.lowest)}, highest {int(self.peak)})"
+
+
+class ThreadLimiter:
+    """Blocking gate that admits at most `controller.limit` threads at a time."""
+
+    def __init__(self, controller):
+        self.controller = controller
+        self._active = 0
+        self._condition = threading.Condition()
+
+    def __enter__(self):
+        with self._condition:
+            self._condition.wait_for(lambda: self._active < self.controller.limit)
+            self._active += 1
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        with self._condition:
+            self._active -= 1
+            self._condition.notify_all()
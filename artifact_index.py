@@ -0,0 +1,229 @@
+import argparse
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from artifact_manifest import artifact_modified
+from cpi_odata import ODataPageError, iter_pages_sync, odata_key
+from http_session import create_session
+
+
+class ArtifactIndex:
+    """Local index of the packages and design-time artifacts of a tenant.
+
+    The index lives in a SQLite database and maps every artifact Id to its
+    package, current version and modification timestamp, plus the size and
+    SHA-256 of the zip once it has been downloaded. Lookups are answered from
+    the database while it is younger than `ttl` seconds. Refreshing is
+    incremental: the package list is fetched, and only packages that are new
+    or whose ModifiedDate changed have their artifacts listed again.
+    """
+
+    def __init__(self, path, base_url, session=None, headers=None, retry_policy=None, ttl=900, workers=8):
+        self.path = path
+        self.base_url = base_url
+        self.session = session or create_session(pool_size=workers)
+        self.headers = headers or {}
+        self.retry_policy = retry_policy
+        self.ttl = ttl
+        self.workers = workers
+        self._local = threading.local()
+        self._refresh_lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls, base_url, headers=None, retry_policy=None, session=None):
+        """Builds the index configured by ARTIFACT_INDEX_PATH, or None if no index is configured."""
+        path = os.environ.get("ARTIFACT_INDEX_PATH")
+        if not path or not base_url:
+            return None
+        return cls(
+            path, base_url,
+            session=session,
+            headers=headers,
+            retry_policy=retry_policy,
+            ttl=float(os.environ.get("ARTIFACT_INDEX_TTL", "900"))
+        )
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("CREATE TABLE IF NOT EXISTS refreshes (tenant TEXT PRIMARY KEY, refreshed REAL)")
+            conn.execute("CREATE TABLE IF NOT EXISTS packages (tenant TEXT, id TEXT, modified TEXT, PRIMARY KEY (tenant, id))")
+            conn.execute("CREATE TABLE IF NOT EXISTS artifacts (tenant TEXT, id TEXT, package_id TEXT, version TEXT, "
+                         "modified TEXT, size INTEGER, content_hash TEXT, PRIMARY KEY (tenant, id))")
+            self._local.conn = conn
+        return conn
+
+    def _write(self, statements):
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for sql, params in statements:
+                conn.execute(sql, params)
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def refreshed_at(self):
+        row = self._connection().execute("SELECT refreshed FROM refreshes WHERE tenant = ?", (self.base_url,)).fetchone()
+        return row['refreshed'] if row else None
+
+    def is_fresh(self):
+        refreshed = self.refreshed_at()
+        return refreshed is not None and time.time() - refreshed < self.ttl
+
+    def _list(self, url):
+        entities = []
+        for results in iter_pages_sync(self.session, url, f"{self.base_url}/", self.retry_policy, 'listing', headers=self.headers, timeout=60):
+            entities.extend(results)
+        return entities
+
+    def refresh(self):
+        """Brings the index up to date, relisting only packages that changed since the last refresh."""
+        with self._refresh_lock:
+            packages = {package['Id']: artifact_modified(package) for package in self._list(f"{self.base_url}/IntegrationPackages?$format=json")}
+            known = {row['id']: row['modified'] for row in self._connection().execute("SELECT id, modified FROM packages WHERE tenant = ?", (self.base_url,))}
+            changed = [package_id for package_id, modified in packages.items() if modified is None or known.get(package_id) != modified]
+            removed = known.keys() - packages.keys()
+
+            def list_artifacts(package_id):
+                return self._list(f"{self.base_url}/IntegrationPackages('{odata_key(package_id)}')/IntegrationDesigntimeArtifacts?$format=json")
+
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                listings = dict(zip(changed, executor.map(list_artifacts, changed)))
+
+            statements = []
+            for package_id in removed:
+                statements.append(("DELETE FROM packages WHERE tenant = ? AND id = ?", (self.base_url, package_id)))
+                statements.append(("DELETE FROM artifacts WHERE tenant = ? AND package_id = ?", (self.base_url, package_id)))
+            for package_id, artifacts in listings.items():
+                ids = [artifact['Id'] for artifact in artifacts]
+                placeholders = ','.join('?' * len(ids))
+                statements.append((f"DELETE FROM artifacts WHERE tenant = ? AND package_id = ? AND id NOT IN ({placeholders})",
+                                   (self.base_url, package_id, *ids)))
+                statements.extend(self._upsert(artifact, package_id) for artifact in artifacts)
+                statements.append(("INSERT OR REPLACE INTO packages (tenant, id, modified) VALUES (?, ?, ?)",
+                                   (self.base_url, package_id, packages[package_id])))
+            statements.append(("INSERT OR REPLACE INTO refreshes (tenant, refreshed) VALUES (?, ?)", (self.base_url, time.time())))
+            self._write(statements)
+            print(f"Artifact index refreshed: {len(packages)} packages, {len(changed)} relisted, {len(removed)} removed.")
+
+    def _upsert(self, artifact, package_id=None):
+        # Size and hash only stay valid while version and modification date are unchanged
+        return ("INSERT INTO artifacts (tenant, id, package_id, version, modified) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (tenant, id) DO UPDATE SET package_id = excluded.package_id, "
+                "size = CASE WHEN version IS excluded.version AND modified IS excluded.modified THEN size END, "
+                "content_hash = CASE WHEN version IS excluded.version AND modified IS excluded.modified THEN content_hash END, "
+                "version = excluded.version, modified = excluded.modified",
+                (self.base_url, artifact['Id'], package_id or artifact.get('PackageId'), artifact.get('Version'), artifact_modified(artifact)))
+
+    def _get(self, artifact_id):
+        row = self._connection().execute("SELECT * FROM artifacts WHERE tenant = ? AND id = ?", (self.base_url, artifact_id)).fetchone()
+        if row is None:
+            return None
+        return {
+            'Id': row['id'],
+            'PackageId': row['package_id'],
+            'Version': row['version'],
+            'ModifiedDate': row['modified'],
+            'Size': row['size'],
+            'ContentHash': row['content_hash']
+        }
+
+    def find(self, artifact_id):
+        """Returns the indexed entry of an artifact, or None if the tenant has no such artifact."""
+        return self.find_many([artifact_id]).get(artifact_id)
+
+    def find_many(self, artifact_ids):
+        """Returns the indexed entries of the given artifacts, keyed by Id.
+
+        A stale index is refreshed first. Ids missing from a fresh index
+        trigger one more incremental refresh, in case they were created since.
+        If the tenant cannot be reached, stale entries are still used.
+        """
+        try:
+            refreshed = False
+            if not self.is_fresh():
+                refreshed = self._try_refresh()
+            entries = {artifact_id: self._get(artifact_id) for artifact_id in artifact_ids}
+            if not refreshed and None in entries.values() and self._try_refresh():
+                entries = {artifact_id: self._get(artifact_id) for artifact_id in artifact_ids}
+            return {artifact_id: entry for artifact_id, entry in entries.items() if entry is not None}
+        except sqlite3.Error as e:
+            print(f"Artifact index '{self.path}' unavailable: {e}")
+            return {}
+
+    def _try_refresh(self):
+        try:
+            self.refresh()
+            return True
+        except (requests.exceptions.RequestException, ODataPageError) as e:
+            print(f"Could not refresh artifact index, using cached entries: {e}")
+            return False
+
+    def package_artifacts(self, package_id):
+        """Returns the indexed entries of all artifacts in a package."""
+        rows = self._connection().execute("SELECT id FROM artifacts WHERE tenant = ? AND package_id = ? ORDER BY id", (self.base_url, package_id))
+        return [self._get(row['id']) for row in rows.fetchall()]
+
+    def record(self, artifact):
+        """Adds or updates a single artifact, e.g. one resolved by a direct lookup."""
+        try:
+            self._write([self._upsert(artifact)])
+        except sqlite3.Error as e:
+            print(f"Could not update artifact index '{self.path}': {e}")
+
+    def record_download(self, artifact_id, version, size, content_hash):
+        """Stores size and SHA-256 of a downloaded zip if it is the indexed version."""
+        try:
+            self._write([("UPDATE artifacts SET size = ?, content_hash = ? WHERE tenant = ? AND id = ? AND version = ?",
+                          (size, content_hash, self.base_url, artifact_id, version))])
+        except sqlite3.Error as e:
+            print(f"Could not update artifact index '{self.path}': {e}")
+
+
+def main():
+    """Refreshes the index and prints the entries of the requested artifacts or packages."""
+    from dotenv import load_dotenv
+    from oauth_tokens import get_token_provider
+    from retry_policy import RetryPolicy
+
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Query the local package/artifact index.")
+    parser.add_argument("ids", nargs='*', help="Artifact IDs to look up.")
+    parser.add_argument("--package", action='append', default=[], help="List the artifacts of a package.")
+    parser.add_argument("--refresh", action='store_true', help="Refresh the index even if it is still fresh.")
+    args = parser.parse_args()
+
+    oauth_url = os.environ.get("OAUTH_URL")
+    client_id = os.environ.get("CLIENT_ID")
+    client_secret = os.environ.get("CLIENT_SECRET")
+    base_url = os.environ.get("BASE_URL")
+
+    if not all([oauth_url, client_id, client_secret, base_url, os.environ.get("ARTIFACT_INDEX_PATH")]):
+        print("Error: OAUTH_URL, CLIENT_ID, CLIENT_SECRET, BASE_URL and ARTIFACT_INDEX_PATH must be set.")
+        exit(1)
+
+    retry_policy = RetryPolicy.from_env()
+    token = get_token_provider(oauth_url, client_id, client_secret, retry_policy).get_token()
+    index = ArtifactIndex.from_env(base_url, {'Authorization': f'Bearer {token}', 'Accept': 'application/json'}, retry_policy)
+
+    if args.refresh or not index.is_fresh():
+        index.refresh()
+    for artifact_id in args.ids:
+        entry = index.find(artifact_id)
+        print(entry if entry else f"{artifact_id}: not found")
+    for package_id in args.package:
+        for entry in index.package_artifacts(package_id):
+            print(entry)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+import asyncio
+import os
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+
+class ByteBudget:
+    """Caps the number of response bytes held in memory across all downloads."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.in_flight = 0
+        self.peak = 0
+        self._condition = asyncio.Condition()
+
+    async def acquire(self, size):
+        """Reserves up to `size` bytes and returns the amount reserved."""
+        size = min(size, self.max_bytes)
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.in_flight + size <= self.max_bytes)
+            self.in_flight += size
+            self.peak = max(self.peak, self.in_flight)
+        return size
+
+    async def release(self, size):
+        async with self._condition:
+            self.in_flight -= size
+            self._condition.notify_all()
+
+
+def _write_lock_file(lock_file_path):
+    with open(lock_file_path, 'w') as f:
+        f.write("lock")
+
+
+def _write_chunk(f, chunk, hasher):
+    f.write(chunk)
+    if hasher is not None:
+        hasher.update(chunk)
+
+
+def extract_zip(file_path, dest_dir):
+    """Extracts a zip into `dest_dir`. Runs in a worker thread or process."""
+    os.makedirs(dest_dir, exist_ok=True)
+    with zipfile.ZipFile(file_path, 'r') as zip_ref:
+        zip_ref.extractall(dest_dir)
+
+
+async def stream_to_file(response, file_path, chunk_size=65536, budget=None, executor=None, hasher=None):
+    """Writes an aiohttp response body to disk chunk by chunk.
+
+    A `.lock` file marks the download as incomplete until the body has been
+    fully written. File operations run on `executor` when one is given, and
+    every chunk is fed to `hasher` (a hashlib object) if one is passed.
+    Returns the number of bytes written.
+    """
+    loop = asyncio.get_running_loop()
+
+    async def run(func, *args):
+        if executor is None:
+            return func(*args)
+        return await loop.run_in_executor(executor, func, *args)
+
+    lock_file_path = f"{file_path}.lock"
+    await run(_write_lock_file, lock_file_path)
+    written = 0
+    try:
+        f = await run(open, file_path, 'wb')
+        try:
+            while True:
+                reserved = await budget.acquire(chunk_size) if budget else 0
+                try:
+                    chunk = await response.content.read(chunk_size)
+                    if not chunk:
+                        break
+                    await run(_write_chunk, f, chunk, hasher)
+                    written += len(chunk)
+                finally:
+                    if budget:
+                        await budget.release(reserved)
+        finally:
+            await run(f.close)
+    finally:
+        await run(os.remove, lock_file_path)
+    return written
+
+
+class ArtifactWriter:
+    """Writes and extracts artifacts on worker pools instead of the event loop.
+
+    Chunk writes go to a small thread pool; zip extraction gets its own pool
+    (threads by default, processes for CPU-heavy inflation) so a large
+    extraction never competes with network reads for the loop.
+    """
+
+    def __init__(self, chunk_size=65536, max_inflight_bytes=None, disk_workers=4,
+                 extract_workers=2, extract_in_processes=False):
+        self.chunk_size = chunk_size
+        self.budget = ByteBudget(max_inflight_bytes) if max_inflight_bytes else None
+        self._disk_executor = ThreadPoolExecutor(disk_workers, thread_name_prefix='artifact-disk')
+        if extract_in_processes:
+            self._extract_executor = ProcessPoolExecutor(extract_workers)
+        else:
+            self._extract_executor = ThreadPoolExecutor(extract_workers, thread_name_prefix='artifact-extract')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def close(self):
+        self._disk_executor.shutdown(wait=True)
+        self._extract_executor.shutdown(wait=True)
+
+    async def makedirs(self, path):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self._disk_executor, lambda: os.makedirs(path, exist_ok=True))
+
+    async def write(self, response, file_path, hasher=None):
+        return await stream_to_file(response, file_path, self.chunk_size, self.budget, self._disk_executor, hasher)
+
+    async def extract(self, file_path, dest_dir):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self._extract_executor, extract_zip, file_path, dest_dir)
+
+
+class LoopLagMonitor:
+    """Measures how long the event loop was blocked while it is running.
+
+    A ticker sleeps for `interval` seconds; any time it wakes up late is time
+    the loop spent blocked on synchronous work.
+    """
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.blocked_seconds = 0.0
+        self.max_lag = 0.0
+        self.samples = 0
+        self._task = None
+
+    async def __aenter__(self):
+        self._task = asyncio.create_task(self._run())
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            lag = max(loop.time() - start - self.interval, 0.0)
+            self.blocked_seconds += lag
+            self.max_lag = max(self.max_lag, lag)
+            self.samples += 1
+
+    def summary(self):
+        return (f"event loop blocked {self.blocked_seconds:.3f}s in total, "
+                f"max {self.max_lag * 1000:.1f}ms over {self.samples} samples")
@@ -0,0 +1,139 @@
+import json
+import os
+import threading
+
+
+def default_manifest_path(output_dir):
+    """The manifest lives next to the output directory, e.g. `Get_All_Packages.manifest.json`."""
+    return f"{os.path.normpath(output_dir)}.manifest.json"
+
+
+def _load_json(path):
+    """Returns the data of a manifest file, or None if there is none or it cannot be read."""
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Ignoring unreadable manifest '{path}': {e}")
+        return None
+
+
+def _save_json(path, data):
+    """Writes a manifest file atomically so an interrupted run never corrupts it."""
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def artifact_modified(result):
+    """Returns the modification timestamp of a listing entry, if the tenant sends one."""
+    for key in ('ModifiedDate', 'ModifiedAt', 'LastModified'):
+        if result.get(key):
+            return result[key]
+    return None
+
+
+class ArtifactManifest:
+    """Records which version of every artifact was exported.
+
+    Entries are keyed by artifact Id and hold the PackageId, Version,
+    modification timestamp and SHA-256 of the downloaded zip. An artifact whose
+    listing metadata still matches its entry, and whose files are still on
+    disk, does not need to be downloaded again.
+    """
+
+    def __init__(self, path, entries=None):
+        self.path = path
+        self.entries = entries or {}
+
+    @classmethod
+    def load(cls, path):
+        data = _load_json(path)
+        return cls(path, data.get('artifacts', {}) if data else None)
+
+    def is_current(self, result, base_output_dir):
+        entry = self.entries.get(result['Id'])
+        if not entry:
+            return False
+        if (entry.get('PackageId') != result['PackageId']
+                or entry.get('Version') != result['Version']
+                or entry.get('Modified') != artifact_modified(result)):
+            return False
+        dest_path = os.path.join(base_output_dir, result['PackageId'])
+        return (os.path.isfile(os.path.join(dest_path, f"{result['Id']}.zip"))
+                and os.path.isdir(os.path.join(dest_path, result['Id'])))
+
+    def record(self, result, content_hash):
+        self.entries[result['Id']] = {
+            'Id': result['Id'],
+            'PackageId': result['PackageId'],
+            'Version': result['Version'],
+            'Modified': artifact_modified(result),
+            'ContentHash': content_hash
+        }
+
+    def save(self):
+        _save_json(self.path, {'artifacts': self.entries})
+
+
+def default_upload_manifest_path(source_dir):
+    """The upload manifest lives next to the source directory, e.g. `Get_All_Packages.upload-manifest.json`."""
+    return f"{os.path.normpath(source_dir)}.upload-manifest.json"
+
+
+class UploadManifest:
+    """Records which content of every iFlow was last uploaded to a tenant.
+
+    Entries are kept per tenant and keyed by artifact Id. Each holds the
+    PackageId, the hash of the local iFlow directory and the Version and
+    modification timestamp the tenant reported after the upload. An iFlow
+    whose directory hash is unchanged, and whose remote metadata still matches,
+    does not need to be uploaded again. Artifacts that a create found already
+    on the tenant get an entry without hash. Entries are recorded from upload
+    threads, so updates are serialized.
+    """
+
+    def __init__(self, path, tenant, data=None):
+        self.path = path
+        self.tenant = tenant
+        self.data = data or {}
+        self.entries = self.data.setdefault('tenants', {}).setdefault(tenant, {})
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path, tenant):
+        return cls(path, tenant, _load_json(path))
+
+    def matching_entry(self, package_id, artifact_id, tree_hash):
+        """Returns the entry of an iFlow if it was last uploaded with the same content."""
+        entry = self.entries.get(artifact_id)
+        if entry and entry.get('PackageId') == package_id and entry.get('TreeHash') == tree_hash:
+            return entry
+        return None
+
+    def is_remote_current(self, entry, remote):
+        return (remote is not None
+                and remote.get('Version') == entry.get('Version')
+                and artifact_modified(remote) == entry.get('Modified'))
+
+    def record(self, package_id, artifact_id, tree_hash, remote):
+        with self._lock:
+            self.entries[artifact_id] = {
+                'Id': artifact_id,
+                'PackageId': package_id,
+                'TreeHash': tree_hash,
+                'Version': remote.get('Version') if remote else None,
+                'Modified': artifact_modified(remote) if remote else None
+            }
+
+    def record_existing(self, package_id, artifact_id):
+        """Notes an artifact the tenant already had, without claiming its content came from here."""
+        self.record(package_id, artifact_id, None, None)
+
+    def save(self):
+        with self._lock:
+            _save_json(self.path, self.data)
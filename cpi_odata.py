@@ -0,0 +1,84 @@
+import asyncio
+from urllib.parse import quote, urljoin
+
+
+class ODataPageError(Exception):
+    """Raised when a listing page cannot be fetched or has no `d.results`."""
+
+    def __init__(self, url, status, message):
+        super().__init__(f"{url} returned {status}: {message}")
+        self.url = url
+        self.status = status
+
+
+def odata_key(value):
+    """Escapes a string for use inside a quoted OData key, e.g. Id='...'."""
+    return quote(value.replace("'", "''"), safe='')
+
+
+async def fetch_page(session, url, retry_policy=None, endpoint='listing', token_provider=None):
+    """Fetches one OData V2 collection page and returns (results, next_link)."""
+    if retry_policy is not None:
+        request = retry_policy.request(session, 'GET', url, endpoint, token_provider=token_provider)
+    else:
+        request = session.get(url)
+    async with request as response:
+        if response.status != 200:
+            raise ODataPageError(url, response.status, await response.text())
+        data = await response.json()
+    d = data.get('d') if isinstance(data, dict) else None
+    if not isinstance(d, dict) or 'results' not in d:
+        raise ODataPageError(url, response.status, "response has no d.results")
+    return d['results'], d.get('__next')
+
+
+async def iter_pages(session, url, service_root=None, retry_policy=None, endpoint='listing', token_provider=None):
+    """Yields the result list of every page of an OData V2 collection.
+
+    `__next` continuation links (which carry the `$skiptoken`) are followed
+    until the server stops sending them; relative links are resolved against
+    `service_root`. The next page is requested before the current one is
+    handed out, so callers can work on a page while the following one loads.
+    Pages are fetched through `retry_policy` when one is given, authenticated
+    with the current token of `token_provider`.
+    """
+    service_root = service_root or url
+    pending = asyncio.ensure_future(fetch_page(session, url, retry_policy, endpoint, token_provider))
+    try:
+        while pending is not None:
+            results, next_link = await pending
+            if next_link:
+                pending = asyncio.ensure_future(fetch_page(session, urljoin(service_root, next_link), retry_policy, endpoint, token_provider))
+            else:
+                pending = None
+            yield results
+    finally:
+        if pending is not None:
+            pending.cancel()
+            await asyncio.gather(pending, return_exceptions=True)
+
+
+async def iter_entities(session, url, service_root=None, retry_policy=None, endpoint='listing', token_provider=None):
+    """Yields the entities of an OData V2 collection one by one across all pages."""
+    async for results in iter_pages(session, url, service_root, retry_policy, endpoint, token_provider):
+        for entity in results:
+            yield entity
+
+
+def iter_pages_sync(session, url, service_root=None, retry_policy=None, endpoint='listing', **kwargs):
+    """Blocking counterpart of `iter_pages` for scripts built on `requests`."""
+    service_root = service_root or url
+    while url:
+        if retry_policy is not None:
+            response = retry_policy.call(lambda: session.get(url, **kwargs), endpoint)
+        else:
+            response = session.get(url, **kwargs)
+        if response.status_code != 200:
+            raise ODataPageError(url, response.status_code, response.text)
+        data = response.json()
+        d = data.get('d') if isinstance(data, dict) else None
+        if not isinstance(d, dict) or 'results' not in d:
+            raise ODataPageError(url, response.status_code, "response has no d.results")
+        yield d['results']
+        next_link = d.get('__next')
+        url = urljoin(service_root, next_link) if next_link else None
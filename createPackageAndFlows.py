@@ -1,44 +1,69 @@
 import requests
 import os
 import argparse
-import base64
-import shutil
-import zipfile
+import multiprocessing
+from collections import Counter
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from retry_policy import RetryPolicy
+from adaptive_concurrency import AimdController, ThreadLimiter
+from oauth_tokens import BearerAuth, get_token_provider
+from csrf_tokens import CsrfTokenManager
+from iflow_archive import DEFAULT_CACHE_MAX_BYTES, cached_zip_and_encode, default_cache_dir, prepare_cache_dir, tree_hash, zip_and_encode
+from artifact_manifest import UploadManifest, default_upload_manifest_path
+from cpi_odata import odata_key
+from odata_batch import build_batch, parse_batch_response
+from http_session import create_session
 # from dotenv import load_dotenv
 # load_dotenv()
 
+# Uploads adapt their concurrency between CONCURRENCY_MIN and UPLOAD_CONCURRENCY
+upload_concurrency = int(os.environ.get("UPLOAD_CONCURRENCY", "8"))
+concurrency_controller = AimdController.from_env(upload_concurrency)
+upload_limiter = ThreadLimiter(concurrency_controller)
+
+# Package and artifact creation is safe to retry: a duplicate create answers 409
+retry_policy = RetryPolicy.from_env(controller=concurrency_controller)
+
+# Zips up to this size are built in memory, larger ones in an unnamed temp file
+zip_spool_threshold = int(os.environ.get("ZIP_SPOOL_THRESHOLD", str(16 * 1024 * 1024)))
+
+# iFlows are zipped and encoded on ZIP_WORKERS processes (0 zips on the upload threads)
+zip_workers = int(os.environ.get("ZIP_WORKERS", str(os.cpu_count() or 1)))
+# 0 stores entries uncompressed, 1-9 deflates at that level; unset uses the zlib default
+zip_compression_level = int(os.environ["ZIP_COMPRESSION_LEVEL"]) if os.environ.get("ZIP_COMPRESSION_LEVEL") else None
+zip_pool = None
+
+# Zips are cached by tree hash so unchanged iFlows are not compressed again; empty disables the cache
+zip_cache_dir = os.environ.get("ZIP_CACHE_DIR", default_cache_dir())
+zip_cache_max_bytes = int(os.environ.get("ZIP_CACHE_MAX_BYTES", str(DEFAULT_CACHE_MAX_BYTES)))
+
+# iFlows whose content matches the upload manifest are skipped unless FULL_UPLOAD is set
+upload_manifest_path = os.environ.get("UPLOAD_MANIFEST_PATH")
+full_upload = os.environ.get("FULL_UPLOAD", "false").lower() in ("1", "true", "yes")
+
+# 'create' leaves existing artifacts alone, 'upsert' updates them in place
+upload_mode = os.environ.get("UPLOAD_MODE", "create").lower()
+
+# With a batch size, creates and updates are sent in OData $batch requests of that many entities
+upload_batch_size = int(os.environ.get("UPLOAD_BATCH_SIZE", "0"))
+upload_changeset_size = int(os.environ.get("UPLOAD_CHANGESET_SIZE", "1"))
+
 def get_oauth_token(oauth_url, client_id, client_secret):
-    payload = {
-        'grant_type': 'client_credentials',
-        'client_id': client_id,
-        'client_secret': client_secret
-    }
     try:
-        auth_response = requests.post(oauth_url, data=payload)
-        auth_response.raise_for_status()
-        return auth_response.json()['access_token']
+        return get_token_provider(oauth_url, client_id, client_secret, retry_policy).get_token()
     except requests.exceptions.RequestException as e:
         print(f"Error getting OAuth token: {e}")
         exit(1)
 
-def fetch_csrf_token(base_url, oauth_token):
+def fetch_csrf_token(csrf):
     try:
-        response = requests.get(
-            f"{base_url}/IntegrationPackages",
-            headers={
-                'Authorization': f'Bearer {oauth_token}',
-                'x-csrf-token': 'fetch'
-            }
-        )
-        response.raise_for_status()
-        return response.headers['x-csrf-token']
+        return csrf.get_token()[0]
     except requests.exceptions.RequestException as e:
         print(f"Error fetching CSRF token: {e}")
         exit(1)
 
-def post_integration_package(base_url, headers, package_id):
-    url = f"{base_url}/IntegrationPackages"
-    data = {
+def package_data(package_id):
+    return {
         "Id": package_id,
         "Name": package_id,
         "Description": package_id,
@@ -46,44 +71,466 @@ def post_integration_package(base_url, headers, package_id):
         "Version": "1.0.0",
         "SupportedPlatform": "SAP Cloud Integration",
     }
+
+def artifact_data(package_id, artifact_id, content):
+    return {
+        "Name": artifact_id,
+        "Id": artifact_id,
+        "PackageId": package_id,
+        "ArtifactContent": content
+    }
+
+def artifact_update_data(artifact_id, content):
+    return {
+        "Name": artifact_id,
+        "ArtifactContent": content
+    }
+
+def artifact_entity(artifact_id):
+    return f"IntegrationDesigntimeArtifacts(Id='{odata_key(artifact_id)}',Version='active')"
+
+def post_integration_package(base_url, headers, package_id, csrf):
+    url = f"{base_url}/IntegrationPackages"
+    data = package_data(package_id)
     try:
-        response = requests.post(url, headers=headers, json=data)
+        with upload_limiter:
+            response = csrf.request('POST', url, 'package', headers=headers, json=data)
         if response.status_code == 201:
             print(f"Integration package '{package_id}' created successfully.")
+            return 'created'
         elif response.status_code == 409: # Conflict, package exists
             print(f"Integration package '{package_id}' already exists.")
+            return 'exists'
         else:
             response.raise_for_status()
     except requests.exceptions.RequestException as e:
         print(f"Error creating integration package '{package_id}': {e}")
-        print(f"Response body: {e.response.text}")
+        if e.response is not None:
+            print(f"Response body: {e.response.text}")
+    return 'failed'
 
-def post_integration_artifact(base_url, headers, package_id, artifact_id, content):
+def post_integration_artifact(base_url, headers, package_id, artifact_id, content, csrf):
     url = f"{base_url}/IntegrationDesigntimeArtifacts"
-    data = {
-        "Name": artifact_id,
-        "Id": artifact_id,
-        "PackageId": package_id,
-        "ArtifactContent": content
-    }
+    data = artifact_data(package_id, artifact_id, content)
     try:
-        response = requests.post(url, headers=headers, json=data)
+        with upload_limiter:
+            response = csrf.request('POST', url, 'artifact', headers=headers, json=data)
         if response.status_code == 201:
             print(f"  - Artifact '{artifact_id}' created successfully.")
+            return 'created'
         elif response.status_code == 409: # Conflict, artifact exists
-             print(f"  - Artifact '{artifact_id}' already exists. Skipping.")
+            if upload_mode != 'upsert':
+                print(f"  - Artifact '{artifact_id}' already exists. Skipping.")
+            return 'exists'
         else:
             response.raise_for_status()
     except requests.exceptions.RequestException as e:
         print(f"Error creating artifact '{artifact_id}': {e}")
-        print(f"Response body: {e.response.text}")
-
-def create_iflow_zip_and_encode(iflow_path):
-    temp_zip = shutil.make_archive("temp_iflow", 'zip', iflow_path)
-    with open(temp_zip, "rb") as zip_file:
-        encoded_zip = base64.b64encode(zip_file.read()).decode("utf-8")
-    os.remove(temp_zip)
-    return encoded_zip
+        if e.response is not None:
+            print(f"Response body: {e.response.text}")
+    return 'failed'
+
+def put_integration_artifact(base_url, headers, artifact_id, content, csrf):
+    """Replaces the content of an existing artifact; returns 'missing' if the tenant has none."""
+    url = f"{base_url}/{artifact_entity(artifact_id)}"
+    data = artifact_update_data(artifact_id, content)
+    try:
+        with upload_limiter:
+            response = csrf.request('PUT', url, 'artifact', headers=headers, json=data)
+        if response.status_code in (200, 202, 204):
+            print(f"  - Artifact '{artifact_id}' updated successfully.")
+            return 'updated'
+        elif response.status_code == 404:
+            return 'missing'
+        else:
+            response.raise_for_status()
+    except requests.exceptions.RequestException as e:
+        print(f"Error updating artifact '{artifact_id}': {e}")
+        if e.response is not None:
+            print(f"Response body: {e.response.text}")
+    return 'failed'
+
+def upsert_integration_artifact(base_url, headers, package_id, artifact_id, content, csrf, exists=False):
+    """Updates the artifact if it exists and creates it otherwise.
+
+    `exists` says which request to try first: an artifact uploaded before is
+    updated straight away, a new one is created and only updated on 409.
+    """
+    if exists:
+        status = put_integration_artifact(base_url, headers, artifact_id, content, csrf)
+        if status != 'missing':
+            return status
+        return post_integration_artifact(base_url, headers, package_id, artifact_id, content, csrf)
+    status = post_integration_artifact(base_url, headers, package_id, artifact_id, content, csrf)
+    if status == 'exists':
+        status = put_integration_artifact(base_url, headers, artifact_id, content, csrf)
+        if status == 'missing':
+            print(f"Error updating artifact '{artifact_id}': it conflicts on create but cannot be found")
+            status = 'failed'
+    return status
+
+def get_artifact_metadata(base_url, headers, artifact_id, csrf):
+    """Returns the active version's entity of an artifact, or None if the tenant has none."""
+    url = f"{base_url}/{artifact_entity(artifact_id)}?$format=json"
+    with upload_limiter:
+        response = retry_policy.call(lambda: csrf.session.get(url, headers=headers, auth=csrf.auth, timeout=60), 'metadata')
+    if response.status_code == 404:
+        return None
+    response.raise_for_status()
+    return response.json().get('d')
+
+def create_iflow_zip_and_encode(iflow_path, content_hash=None):
+    if zip_cache_dir:
+        return cached_zip_and_encode(iflow_path, zip_cache_dir, zip_spool_threshold, zip_compression_level, content_hash, zip_cache_max_bytes)
+    return zip_and_encode(iflow_path, zip_spool_threshold, zip_compression_level)
+
+def start_zip_pool():
+    """Starts the zip processes; called before any upload thread exists.
+
+    Workers are started by a forkserver (or spawned where there is none)
+    rather than forked from a process that is running threads.
+    """
+    global zip_pool
+    if zip_workers > 0:
+        method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+        zip_pool = ProcessPoolExecutor(max_workers=zip_workers, mp_context=multiprocessing.get_context(method))
+
+def submit_iflow_zip(iflow_path, content_hash=None):
+    """Starts zipping and encoding an iFlow on the zip process pool and returns its future.
+
+    Without a pool the iFlow is zipped on the calling thread.
+    """
+    future = Future()
+    try:
+        if zip_pool is None:
+            future.set_result(create_iflow_zip_and_encode(iflow_path, content_hash))
+        elif zip_cache_dir:
+            future = zip_pool.submit(cached_zip_and_encode, iflow_path, zip_cache_dir, zip_spool_threshold, zip_compression_level,
+                                     content_hash, zip_cache_max_bytes)
+        else:
+            future = zip_pool.submit(zip_and_encode, iflow_path, zip_spool_threshold, zip_compression_level)
+    except Exception as e:
+        # A broken pool refuses new work; the error surfaces from wait_for_zip like any other
+        future.set_exception(e)
+    return future
+
+def shutdown_zip_pool():
+    global zip_pool
+    if zip_pool is not None:
+        zip_pool.shutdown()
+        zip_pool = None
+
+def wait_for_zip(iflow_id, future):
+    """Returns the encoded content of a submitted zip, or None if zipping failed.
+
+    Any error, including a zip process that died, only fails this iFlow.
+    """
+    try:
+        return future.result()
+    except Exception as e:
+        print(f"Error zipping iFlow '{iflow_id}': {e}")
+        return None
+
+def remote_check(manifest, package_id, iflow_id, content_hash):
+    """Returns (entry, check): the manifest entry matching the iFlow's content, and
+    whether the tenant has to be asked about the iFlow before it is zipped.
+
+    Only iFlows the manifest knows are looked up, so new ones cost no extra
+    request: one whose content matches its last upload may be unchanged, and
+    in create mode one the tenant had before would only be refused again.
+    """
+    if manifest is None or full_upload:
+        return None, False
+    entry = manifest.matching_entry(package_id, iflow_id, content_hash)
+    return entry, bool(entry) or (upload_mode != 'upsert' and iflow_id in manifest.entries)
+
+def remote_check_status(manifest, iflow_id, entry, remote):
+    """Status of an iFlow after looking it up on the tenant, or None if it is to be sent."""
+    if entry and manifest.is_remote_current(entry, remote):
+        print(f"  - Artifact '{iflow_id}' is unchanged. Skipping.")
+        return 'unchanged'
+    if remote is not None and upload_mode != 'upsert':
+        print(f"  - Artifact '{iflow_id}' already exists. Skipping.")
+        return 'exists'
+    return None
+
+def prepare_iflow(base_url, headers, package_id, iflow_id, iflow_path, csrf, manifest=None):
+    """Starts zipping one iFlow directory unless it does not need to be sent.
+
+    With a manifest, iFlows it knows are first checked with a metadata
+    request (see `remote_check`). Returns (status, content_hash, zip_future);
+    status is None if the iFlow is to be sent.
+    """
+    print(f"  - Processing iFlow: {iflow_id}")
+    try:
+        content_hash = tree_hash(iflow_path) if manifest is not None else None
+        entry, check = remote_check(manifest, package_id, iflow_id, content_hash)
+        if check:
+            status = remote_check_status(manifest, iflow_id, entry, get_artifact_metadata(base_url, headers, iflow_id, csrf))
+            if status:
+                return status, content_hash, None
+        return None, content_hash, submit_iflow_zip(iflow_path, content_hash)
+    except OSError as e:
+        print(f"Error reading iFlow '{iflow_id}': {e}")
+    except requests.exceptions.RequestException as e:
+        print(f"Error checking artifact '{iflow_id}': {e}")
+    return 'failed', None, None
+
+def upload_iflow(base_url, headers, package_id, iflow_id, iflow_path, csrf, manifest=None):
+    """Zips one iFlow directory and creates, or in upsert mode updates, its artifact."""
+    status, content_hash, zip_future = prepare_iflow(base_url, headers, package_id, iflow_id, iflow_path, csrf, manifest)
+    if status:
+        return status
+    encoded_content = wait_for_zip(iflow_id, zip_future)
+    if encoded_content is None:
+        return 'failed'
+    if upload_mode == 'upsert':
+        uploaded_before = manifest is not None and iflow_id in manifest.entries
+        status = upsert_integration_artifact(base_url, headers, package_id, iflow_id, encoded_content, csrf, exists=uploaded_before)
+    else:
+        status = post_integration_artifact(base_url, headers, package_id, iflow_id, encoded_content, csrf)
+    if manifest is not None and status in ('created', 'updated'):
+        try:
+            manifest.record(package_id, iflow_id, content_hash, get_artifact_metadata(base_url, headers, iflow_id, csrf))
+        except requests.exceptions.RequestException as e:
+            print(f"Could not read back artifact '{iflow_id}': {e}")
+    elif manifest is not None and status == 'exists':
+        manifest.record_existing(package_id, iflow_id)
+    return status
+
+def send_batch(base_url, headers, batch_requests, csrf, changeset_size=None):
+    """Sends (method, url, body) requests in one $batch and returns a response per request.
+
+    If the whole batch fails, every request gets None. Requests of a
+    changeset that failed as a whole were not applied, so they are sent
+    again one per changeset to get an answer for each of them.
+    """
+    changeset_size = changeset_size or upload_changeset_size
+    content_type, body, groups = build_batch(batch_requests, changeset_size)
+    try:
+        with upload_limiter:
+            response = csrf.request('POST', f"{base_url}/$batch", 'batch', headers=dict(headers, **{'Content-Type': content_type}), data=body)
+        response.raise_for_status()
+        responses = parse_batch_response(response.headers.get('Content-Type'), response.content, groups)
+    except (requests.exceptions.RequestException, ValueError) as e:
+        print(f"Error sending $batch of {len(batch_requests)} requests: {e}")
+        return [None] * len(batch_requests)
+    shared = [i for i, answer in enumerate(responses) if answer.changeset_error]
+    if shared:
+        print(f"A changeset failed as a whole ({responses[shared[0]].status_code}), sending its {len(shared)} requests one by one.")
+        for i, answer in zip(shared, send_batch(base_url, headers, [batch_requests[i] for i in shared], csrf, changeset_size=1)):
+            responses[i] = answer
+    return responses
+
+def batch_entity(response):
+    """Returns the entity in the body of a $batch GET; raises ValueError if it holds none."""
+    data = response.json()
+    if not isinstance(data, dict) or not isinstance(data.get('d'), dict):
+        raise ValueError("response holds no entity")
+    return data['d']
+
+def batch_failure(action, item_id, response):
+    if response is not None:
+        print(f"Error {action} '{item_id}': {response.status_code}")
+        print(f"Response body: {response.text}")
+    return 'failed'
+
+def create_package_batch(base_url, headers, package_ids, csrf):
+    """Creates packages with one $batch and returns (package_id, status) pairs."""
+    responses = send_batch(base_url, headers, [('POST', 'IntegrationPackages', package_data(package_id)) for package_id in package_ids], csrf)
+    results = []
+    for package_id, response in zip(package_ids, responses):
+        if response is not None and response.status_code == 201:
+            print(f"Integration package '{package_id}' created successfully.")
+            status = 'created'
+        elif response is not None and response.status_code == 409:
+            print(f"Integration package '{package_id}' already exists.")
+            status = 'exists'
+        else:
+            status = batch_failure('creating integration package', package_id, response)
+        results.append((package_id, status))
+    return results
+
+def batch_artifact_status(method, response, artifact_id):
+    if response is not None and method == 'POST' and response.status_code == 201:
+        print(f"  - Artifact '{artifact_id}' created successfully.")
+        return 'created'
+    if response is not None and method == 'POST' and response.status_code == 409:
+        if upload_mode != 'upsert':
+            print(f"  - Artifact '{artifact_id}' already exists. Skipping.")
+        return 'exists'
+    if response is not None and method == 'PUT' and response.status_code in (200, 202, 204):
+        print(f"  - Artifact '{artifact_id}' updated successfully.")
+        return 'updated'
+    if response is not None and method == 'PUT' and response.status_code == 404:
+        return 'missing'
+    return batch_failure('creating artifact' if method == 'POST' else 'updating artifact', artifact_id, response)
+
+def upload_iflow_batch(base_url, headers, items, csrf, manifest=None):
+    """Zips a group of iFlows on the zip pool and creates or updates them with $batch requests.
+
+    In upsert mode a create that conflicts is followed by an update, and an
+    update of an artifact that is gone by a create, in one more $batch. With a
+    manifest, the iFlows it knows are first looked up with one $batch of GETs
+    (see `remote_check`), and the new versions are read back with a final one.
+    Returns (package_id, iflow_id, status) triples.
+    """
+    statuses = {}
+    contents = {}
+    hashes = {}
+    zip_futures = {}
+    checks = {}
+    for i, (package_id, iflow_id, iflow_path) in enumerate(items):
+        print(f"  - Processing iFlow: {iflow_id}")
+        try:
+            hashes[i] = tree_hash(iflow_path) if manifest is not None else None
+        except OSError as e:
+            print(f"Error reading iFlow '{iflow_id}': {e}")
+            statuses[i] = 'failed'
+            continue
+        entry, check = remote_check(manifest, package_id, iflow_id, hashes[i])
+        if check:
+            checks[i] = entry
+    if checks:
+        responses = send_batch(base_url, headers, [('GET', f"{artifact_entity(items[i][1])}?$format=json", None) for i in checks], csrf)
+        for (i, entry), response in zip(checks.items(), responses):
+            try:
+                if response is None or response.status_code not in (200, 404):
+                    status = batch_failure('checking artifact', items[i][1], response)
+                else:
+                    remote = batch_entity(response) if response.status_code == 200 else None
+                    status = remote_check_status(manifest, items[i][1], entry, remote)
+            except ValueError as e:
+                print(f"Error checking artifact '{items[i][1]}': {e}")
+                status = 'failed'
+            if status:
+                statuses[i] = status
+    # All zips of the batch are built in parallel while other batches upload
+    for i, (_, _, iflow_path) in enumerate(items):
+        if i not in statuses:
+            zip_futures[i] = submit_iflow_zip(iflow_path, hashes[i])
+    for i, future in zip_futures.items():
+        contents[i] = wait_for_zip(items[i][1], future)
+        if contents[i] is None:
+            statuses[i] = 'failed'
+
+    def batch_request(i, method):
+        package_id, iflow_id, _ = items[i]
+        if method == 'PUT':
+            return ('PUT', artifact_entity(iflow_id), artifact_update_data(iflow_id, contents[i]))
+        return ('POST', 'IntegrationDesigntimeArtifacts', artifact_data(package_id, iflow_id, contents[i]))
+
+    pending = {}
+    for i in range(len(items)):
+        if i not in statuses:
+            uploaded_before = upload_mode == 'upsert' and manifest is not None and items[i][1] in manifest.entries
+            pending[i] = 'PUT' if uploaded_before else 'POST'
+    for attempt in range(2):
+        if not pending:
+            break
+        order = list(pending.items())
+        responses = send_batch(base_url, headers, [batch_request(i, method) for i, method in order], csrf)
+        pending = {}
+        for (i, method), response in zip(order, responses):
+            status = batch_artifact_status(method, response, items[i][1])
+            if upload_mode == 'upsert' and attempt == 0 and status in ('exists', 'missing'):
+                pending[i] = 'PUT' if status == 'exists' else 'POST'
+                continue
+            if status == 'missing':
+                print(f"Error updating artifact '{items[i][1]}': it conflicts on create but cannot be found")
+                status = 'failed'
+            statuses[i] = status
+
+    uploaded = [i for i, status in statuses.items() if status in ('created', 'updated')]
+    if manifest is not None and uploaded:
+        responses = send_batch(base_url, headers, [('GET', f"{artifact_entity(items[i][1])}?$format=json", None) for i in uploaded], csrf)
+        for i, response in zip(uploaded, responses):
+            if response is None or response.status_code != 200:
+                print(f"Could not read back artifact '{items[i][1]}'")
+                continue
+            try:
+                manifest.record(items[i][0], items[i][1], hashes[i], batch_entity(response))
+            except ValueError as e:
+                print(f"Could not read back artifact '{items[i][1]}': {e}")
+    if manifest is not None:
+        for i, status in statuses.items():
+            if status == 'exists' and items[i][1] not in manifest.entries:
+                manifest.record_existing(items[i][0], items[i][1])
+    return [(package_id, iflow_id, statuses[i]) for i, (package_id, iflow_id, _) in enumerate(items)]
+
+def upload_packages_batched(base_url, headers, packages_path, csrf, manifest=None):
+    """Like `upload_packages`, but sends packages and artifacts in $batch requests of UPLOAD_BATCH_SIZE."""
+    results = []
+    with ThreadPoolExecutor(max_workers=upload_concurrency) as executor:
+        package_ids = list_subdirectories(packages_path)
+        package_futures = [
+            executor.submit(create_package_batch, base_url, headers, package_ids[i:i + upload_batch_size], csrf)
+            for i in range(0, len(package_ids), upload_batch_size)
+        ]
+        artifact_futures = []
+        items = []
+        for future in as_completed(package_futures):
+            for package_id, status in future.result():
+                results.append(('package', package_id, package_id, status))
+                package_path = os.path.join(packages_path, package_id)
+                for iflow_id in list_subdirectories(package_path):
+                    if status == 'failed':
+                        results.append(('artifact', package_id, iflow_id, 'skipped'))
+                    else:
+                        items.append((package_id, iflow_id, os.path.join(package_path, iflow_id)))
+                while len(items) >= upload_batch_size:
+                    artifact_futures.append(executor.submit(upload_iflow_batch, base_url, headers, items[:upload_batch_size], csrf, manifest))
+                    items = items[upload_batch_size:]
+        if items:
+            artifact_futures.append(executor.submit(upload_iflow_batch, base_url, headers, items, csrf, manifest))
+        for future in as_completed(artifact_futures):
+            results.extend(('artifact', package_id, iflow_id, status) for package_id, iflow_id, status in future.result())
+    return results
+
+def list_subdirectories(path):
+    return [name for name in os.listdir(path) if os.path.isdir(os.path.join(path, name))]
+
+def upload_packages(base_url, headers, packages_path, csrf, manifest=None):
+    """Creates all packages and their artifacts on a pool of UPLOAD_CONCURRENCY threads.
+
+    Packages are created concurrently; as soon as a package exists its
+    artifacts are queued, so artifact uploads of different packages overlap
+    and zipping on the zip process pool overlaps with uploads.
+    Artifacts of a package that could not be created are skipped. Returns a
+    list of (kind, package_id, item_id, status) results.
+    """
+    results = []
+    with ThreadPoolExecutor(max_workers=upload_concurrency) as executor:
+        package_futures = {
+            executor.submit(post_integration_package, base_url, headers, package_id, csrf): package_id
+            for package_id in list_subdirectories(packages_path)
+        }
+        artifact_futures = {}
+        for future in as_completed(package_futures):
+            package_id = package_futures[future]
+            status = future.result()
+            results.append(('package', package_id, package_id, status))
+            package_path = os.path.join(packages_path, package_id)
+            for iflow_id in list_subdirectories(package_path):
+                if status == 'failed':
+                    results.append(('artifact', package_id, iflow_id, 'skipped'))
+                    continue
+                future = executor.submit(upload_iflow, base_url, headers, package_id, iflow_id, os.path.join(package_path, iflow_id), csrf, manifest)
+                artifact_futures[future] = (package_id, iflow_id)
+        for future in as_completed(artifact_futures):
+            package_id, iflow_id = artifact_futures[future]
+            results.append(('artifact', package_id, iflow_id, future.result()))
+    return results
+
+def print_upload_summary(results):
+    for kind in ('package', 'artifact'):
+        counts = Counter(status for item_kind, _, _, status in results if item_kind == kind)
+        totals = ", ".join(f"{count} {status}" for status, count in sorted(counts.items())) or "none"
+        print(f"{kind.capitalize()}s: {totals}")
+    for kind, package_id, item_id, status in results:
+        if status == 'failed' or status == 'skipped':
+            print(f"  {status}: {kind} '{item_id}' (package '{package_id}')")
+
 # Load env vars
 oauth_url = os.environ.get("OAUTH_URL")
 client_id = os.environ.get("CLIENT_ID")
@@ -97,18 +544,29 @@ def main():
     parser.add_argument('--source-dir', default='Get_All_Packages', help='The directory containing the packages to restore.')
     args = parser.parse_args()
 
+    if upload_mode not in ('create', 'upsert'):
+        print(f"Error: UPLOAD_MODE must be 'create' or 'upsert', not '{upload_mode}'.")
+        exit(1)
+
+    if zip_compression_level is not None and not 0 <= zip_compression_level <= 9:
+        print(f"Error: ZIP_COMPRESSION_LEVEL must be between 0 and 9, not {zip_compression_level}.")
+        exit(1)
+
     if not all([oauth_url, client_id, client_secret, base_url]):
         print("Error: One or more environment variables (OAUTH_URL, CLIENT_ID, CLIENT_SECRET, BASE_URL) are not set.")
         exit(1)
 
-    oauth_token = get_oauth_token(oauth_url, client_id, client_secret)
-    csrf_token = fetch_csrf_token(base_url, oauth_token)
+    get_oauth_token(oauth_url, client_id, client_secret)
+    # Long restores outlive a single token, so every request asks the provider for a current one
+    auth = BearerAuth(get_token_provider(oauth_url, client_id, client_secret, retry_policy))
+    # The session keeps the cookies the CSRF token is bound to and one pooled connection per upload thread
+    session = create_session(pool_size=upload_concurrency)
+    csrf = CsrfTokenManager(session, f"{base_url}/", auth=auth, retry_policy=retry_policy)
+    fetch_csrf_token(csrf)
 
     headers = {
         'Content-Type': 'application/json',
-        'Accept': 'application/json',
-        'Authorization': f'Bearer {oauth_token}',
-        'x-csrf-token': csrf_token
+        'Accept': 'application/json'
     }
 
     packages_path = args.source_dir
@@ -116,22 +574,23 @@ def main():
         print(f"Error: Directory '{packages_path}' not found.")
         exit(1)
 
-    package_ids = [name for name in os.listdir(packages_path) if os.path.isdir(os.path.join(packages_path, name))]
-
-    for package_id in package_ids:
-        print(f"Processing package: {package_id}")
-        post_integration_package(base_url, headers, package_id)
-        
-        package_path = os.path.join(packages_path, package_id)
-        iflow_ids = [name for name in os.listdir(package_path) if os.path.isdir(os.path.join(package_path, name))]
-
-        for iflow_id in iflow_ids:
-            iflow_path = os.path.join(package_path, iflow_id)
-            print(f"  - Processing iFlow: {iflow_id}")
-            
-            iflow_content_path = iflow_path
-            encoded_content = create_iflow_zip_and_encode(iflow_content_path)
-            post_integration_artifact(base_url, headers, package_id, iflow_id, encoded_content)
+    global zip_cache_dir
+    if zip_cache_dir and not prepare_cache_dir(zip_cache_dir):
+        zip_cache_dir = None
+
+    manifest = UploadManifest.load(upload_manifest_path or default_upload_manifest_path(packages_path), base_url)
+    start_zip_pool()
+    try:
+        if upload_batch_size > 0:
+            results = upload_packages_batched(base_url, headers, packages_path, csrf, manifest)
+        else:
+            results = upload_packages(base_url, headers, packages_path, csrf, manifest)
+    finally:
+        manifest.save()
+        shutdown_zip_pool()
+    print_upload_summary(results)
+    print(retry_policy.summary())
+    print(concurrency_controller.summary())
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
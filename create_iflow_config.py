@@ -3,19 +3,18 @@ import os
 import requests
 import json
 from dotenv import load_dotenv
+from http_session import create_session
+from retry_policy import RetryPolicy
+from oauth_tokens import get_token_provider
 
 load_dotenv()
 
+retry_policy = RetryPolicy.from_env()
+http_session = create_session()
+
 def get_oauth_token(oauth_url, client_id, client_secret):
-    payload = {
-        'grant_type': 'client_credentials',
-        'client_id': client_id,
-        'client_secret': client_secret
-    }
     try:
-        auth_response = requests.post(oauth_url, data=payload)
-        auth_response.raise_for_status()
-        return auth_response.json()['access_token']
+        return get_token_provider(oauth_url, client_id, client_secret, retry_policy).get_token()
     except requests.exceptions.RequestException as e:
         print(f"Error getting OAuth token: {e}")
         return None
@@ -49,7 +48,7 @@ def create_iflow_config(iflow_name, env, output_dir="."):
     api_url = f"{base_url}/IntegrationDesigntimeArtifacts(Id='{iflow_name}',Version='active')/Configurations?$format=json"
 
     try:
-        response = requests.get(api_url, headers=headers)
+        response = retry_policy.call(lambda: http_session.get(api_url, headers=headers), 'configurations')
         response.raise_for_status()
         data = response.json()
         
@@ -0,0 +1,78 @@
+import threading
+
+import requests
+
+
+def is_csrf_failure(response):
+    """True if the tenant rejected a request because of a missing or expired CSRF token."""
+    if response.status_code != 403:
+        return False
+    if response.headers.get('x-csrf-token', '').lower() == 'required':
+        return True
+    return 'csrf token validation failed' in response.text.lower()
+
+
+class CsrfTokenManager:
+    """Caches the X-CSRF-Token of a tenant together with the cookies it is bound to.
+
+    The token is fetched with a HEAD on the service root (falling back to a
+    GET of the small service document), not with a full collection listing.
+    Modifying requests sent through `request` carry the token and its cookies;
+    when the tenant answers `403 CSRF token validation failed` the token is
+    fetched again once and the request is repeated. Concurrent writers that
+    hit an expired token wait for a single shared refresh.
+    """
+
+    def __init__(self, session, service_root, auth=None, retry_policy=None):
+        self.session = session
+        self.service_root = service_root
+        self.auth = auth
+        self.retry_policy = retry_policy
+        self.refreshes = 0
+        self._token = None
+        self._cookies = None
+        self._lock = threading.Lock()
+
+    def _send(self, send, endpoint):
+        return self.retry_policy.call(send, endpoint) if self.retry_policy else send()
+
+    def _fetch(self):
+        headers = {'X-CSRF-Token': 'Fetch'}
+        response = self._send(lambda: self.session.head(self.service_root, headers=headers, auth=self.auth), 'csrf')
+        if not response.headers.get('x-csrf-token'):
+            response = self._send(lambda: self.session.get(self.service_root, headers=headers, auth=self.auth), 'csrf')
+        response.raise_for_status()
+        token = response.headers.get('x-csrf-token')
+        if not token or token.lower() == 'required':
+            raise requests.exceptions.RequestException(f"No CSRF token returned by {self.service_root}", response=response)
+        self._token = token
+        self._cookies = requests.utils.dict_from_cookiejar(self.session.cookies)
+        self.refreshes += 1
+
+    def get_token(self):
+        with self._lock:
+            if self._token is None:
+                self._fetch()
+            return self._token, self._cookies
+
+    def refresh(self, stale_token):
+        """Fetches a new token unless another writer already replaced `stale_token`."""
+        with self._lock:
+            if self._token == stale_token:
+                self._fetch()
+            return self._token, self._cookies
+
+    def request(self, method, url, endpoint, headers=None, **kwargs):
+        """Sends a modifying request with the CSRF token, re-fetching it once if the tenant rejects it."""
+        token, cookies = self.get_token()
+        for retried in (False, True):
+            request_headers = dict(headers or {}, **{'X-CSRF-Token': token})
+
+            def send():
+                return self.session.request(method, url, headers=request_headers, cookies=cookies, auth=self.auth, **kwargs)
+
+            response = self._send(send, endpoint)
+            if retried or not is_csrf_failure(response):
+                return response
+            print(f"CSRF token rejected for {endpoint}, fetching a new one.")
+            token, cookies = self.refresh(token)
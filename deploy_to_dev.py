@@ -3,18 +3,18 @@ import os
 import argparse
 import sys
 import time
+from http_session import create_session
+from retry_policy import RetryPolicy
+from oauth_tokens import get_token_provider
+
+retry_policy = RetryPolicy.from_env()
+# Deploy and every status poll reuse the same keep-alive connection
+http_session = create_session()
 
 def getOAuthToken(oauth_url, client_id, client_secret):
-    """Fetches OAuth token."""
-    payload = {
-        'grant_type': 'client_credentials',
-        'client_id': client_id,
-        'client_secret': client_secret
-    }
+    """Fetches OAuth token, reusing a cached one while it is still valid."""
     try:
-        auth_response = requests.post(oauth_url, data=payload, timeout=30)
-        auth_response.raise_for_status()
-        return auth_response.json()['access_token']
+        return get_token_provider(oauth_url, client_id, client_secret, retry_policy).get_token()
     except requests.exceptions.RequestException as e:
         print(f"❌ OAuth error: {e}")
         return None
@@ -36,7 +36,12 @@ def deploy_iflow_to_dev(iflow_name, base_url, oauth_token):
         }
         
         print(f'🚀 Direct deploying iFlow {iflow_name} to DEV...')
-        response = requests.post(deploy_url, headers=headers, json=deploy_payload, timeout=60)
+        # Only retry the deploy when the tenant turned it away before processing it
+        response = retry_policy.call(
+            lambda: http_session.post(deploy_url, headers=headers, json=deploy_payload, timeout=60),
+            'deploy',
+            statuses={429, 503}
+        )
         
         if response.status_code in [200, 202]:
             print(f'✅ Direct deployment to DEV initiated')
@@ -45,7 +50,7 @@ def deploy_iflow_to_dev(iflow_name, base_url, oauth_token):
             for i in range(18):  # Wait up to 3 minutes
                 time.sleep(10)
                 status_url = f'{base_url}/IntegrationRuntimeArtifacts?$filter=Id eq \'{iflow_name}\''
-                status_response = requests.get(status_url, headers=headers, timeout=30)
+                status_response = retry_policy.call(lambda: http_session.get(status_url, headers=headers, timeout=30), 'status')
                 
                 if status_response.status_code == 200:
                     runtime_data = status_response.json()
@@ -0,0 +1,134 @@
+import asyncio
+from collections import deque
+
+
+class DownloadScheduler:
+    """Runs download jobs on a fixed pool of workers.
+
+    Jobs are queued per endpoint (for example 'listing' and 'artifact') in
+    bounded queues. Workers pick jobs round-robin across endpoints so listing
+    calls and artifact calls interleave fairly, and every endpoint has its own
+    concurrency limit below the global one. When a `controller` (an
+    AimdController) is given, only `controller.limit` of the workers run jobs
+    at any time.
+
+    Jobs queued from inside running jobs through `defer` wait in at most
+    `queue_size` feeders; a job deferring beyond that waits itself, without
+    counting against the controller limit.
+    """
+
+    def __init__(self, endpoints, max_concurrency=8, endpoint_concurrency=6, queue_size=100, controller=None):
+        self._queues = {endpoint: deque() for endpoint in endpoints}
+        self._active = {endpoint: 0 for endpoint in endpoints}
+        self._order = deque(endpoints)
+        self._max_concurrency = max_concurrency
+        # Keep a worker free for other endpoints, so jobs waiting in `defer` never hold them all
+        if len(endpoints) > 1:
+            if max_concurrency < 2:
+                raise ValueError(f"max_concurrency must be at least 2 with several endpoints, not {max_concurrency}")
+            endpoint_concurrency = max(1, min(endpoint_concurrency, max_concurrency - 1))
+        self._endpoint_concurrency = endpoint_concurrency
+        self._queue_size = queue_size
+        self._controller = controller
+        self._running = 0
+        self._blocked = 0
+        self._feeder_slots = asyncio.Semaphore(queue_size)
+        self._condition = asyncio.Condition()
+        self._unfinished = 0
+        self._workers = []
+        self._feeders = set()
+        self.completed = 0
+        self.failed = 0
+
+    async def __aenter__(self):
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self._max_concurrency)]
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        tasks = list(self._feeders) + self._workers
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def submit(self, endpoint, job, *args):
+        """Queues a job, waiting while the endpoint queue is full."""
+        self._unfinished += 1
+        await self._enqueue(endpoint, job, args)
+
+    async def defer(self, endpoint, job, *args):
+        """Queues a job from inside a running job.
+
+        The job is handed to a feeder task, so the caller does not wait for
+        queue space. Once `queue_size` feeders are pending the caller waits for
+        one to finish; meanwhile it does not count as running.
+        """
+        if self._feeder_slots.locked():
+            # Let an idle worker take over the slot this job no longer uses
+            async with self._condition:
+                self._blocked += 1
+                self._condition.notify_all()
+            try:
+                await self._feeder_slots.acquire()
+            finally:
+                self._blocked -= 1
+                async with self._condition:
+                    self._condition.notify_all()
+        else:
+            await self._feeder_slots.acquire()
+        self._unfinished += 1
+        feeder = asyncio.create_task(self._feed(endpoint, job, args))
+        self._feeders.add(feeder)
+        feeder.add_done_callback(self._feeders.discard)
+
+    async def _feed(self, endpoint, job, args):
+        try:
+            await self._enqueue(endpoint, job, args)
+        finally:
+            self._feeder_slots.release()
+
+    async def join(self):
+        """Waits until every submitted and deferred job has finished."""
+        async with self._condition:
+            await self._condition.wait_for(lambda: self._unfinished == 0)
+
+    async def _enqueue(self, endpoint, job, args):
+        async with self._condition:
+            queue = self._queues[endpoint]
+            await self._condition.wait_for(lambda: len(queue) < self._queue_size)
+            queue.append((job, args))
+            self._condition.notify_all()
+
+    def _next_job(self):
+        if self._controller is not None and self._running - self._blocked >= self._controller.limit:
+            return None
+        for _ in range(len(self._order)):
+            endpoint = self._order[0]
+            self._order.rotate(-1)
+            if self._queues[endpoint] and self._active[endpoint] < self._endpoint_concurrency:
+                self._active[endpoint] += 1
+                self._running += 1
+                job, args = self._queues[endpoint].popleft()
+                return endpoint, job, args
+        return None
+
+    async def _worker(self):
+        while True:
+            async with self._condition:
+                picked = self._next_job()
+                while picked is None:
+                    await self._condition.wait()
+                    picked = self._next_job()
+                endpoint, job, args = picked
+                self._condition.notify_all()
+            try:
+                await job(*args)
+                self.completed += 1
+            except Exception as e:
+                self.failed += 1
+                print(f"Error in {endpoint} job {getattr(job, '__name__', job)}: {e}")
+            finally:
+                async with self._condition:
+                    self._active[endpoint] -= 1
+                    self._running -= 1
+                    self._unfinished -= 1
+                    self._condition.notify_all()
@@ -1,96 +1,238 @@
 import requests
 import os
+import hashlib
 import jinja2
 import aiohttp
 import asyncio
 import ssl
-import zipfile
 import argparse
+from contextlib import aclosing
+from artifact_index import ArtifactIndex
+from artifact_io import extract_zip, stream_to_file
+from cpi_odata import ODataPageError, iter_entities, iter_pages, odata_key
+from retry_policy import RetryPolicy
+from oauth_tokens import get_token_provider
 
 # Disable SSL certificate verification
 ssl_context = ssl.create_default_context()
 ssl_context.check_hostname = False
 ssl_context.verify_mode = ssl.CERT_NONE
 
+# Artifact bodies are streamed to disk in chunks of this size
+download_chunk_size = int(os.environ.get("DOWNLOAD_CHUNK_SIZE", str(64 * 1024)))
+
+# Maximum number of package listings in flight while scanning for an iFlow
+scan_concurrency = int(os.environ.get("SCAN_CONCURRENCY", "8"))
+
+retry_policy = RetryPolicy.from_env()
+
 def getOAuthToken(oauth_url, client_id, client_secret):
-    """Fetches OAuth token."""
-    payload = {
-        'grant_type': 'client_credentials',
-        'client_id': client_id,
-        'client_secret': client_secret
-    }
+    """Fetches OAuth token, reusing a cached one while it is still valid."""
     try:
-        auth_response = requests.post(oauth_url, data=payload)
-        auth_response.raise_for_status()
-        return auth_response.json()['access_token']
+        return get_token_provider(oauth_url, client_id, client_secret, retry_policy).get_token()
     except requests.exceptions.RequestException as e:
         print(f"Error getting OAuth token: {e}")
         return None
 
-async def find_and_download_iflow(iflow_name, version, package_url, artifacts_url, headers, base_output_dir):
-    """Finds a specific iFlow across all packages and downloads it."""
-    base_url = f"{os.environ.get('BASE_URL')}/IntegrationPackages"
-    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(ssl=ssl_context), headers=headers) as session:
-        try:
-            async with session.get(f"{base_url}?$format=json") as response:
-                response.raise_for_status()
-                data = await response.json()
-                package_ids = [package['Id'] for package in data['d']['results']]
-        except aiohttp.ClientError as e:
-            print(f"Error fetching packages: {e}")
-            return False
+async def lookup_artifact(session, base_url, iflow_name, version):
+    """Resolves an iFlow directly through its IntegrationDesigntimeArtifacts entity.
+
+    Returns the entity (with PackageId and the resolved Version) or None if the
+    lookup fails, in which case the caller falls back to a package scan.
+    """
+    url = f"{base_url}/IntegrationDesigntimeArtifacts(Id='{odata_key(iflow_name)}',Version='{odata_key(version)}')?$format=json"
+    try:
+        async with retry_policy.request(session, 'GET', url, 'lookup') as response:
+            if response.status != 200:
+                print(f"Direct lookup of iFlow '{iflow_name}' returned {response.status}, scanning packages instead.")
+                return None
+            data = await response.json()
+    except (aiohttp.ClientError, ValueError) as e:
+        print(f"Direct lookup of iFlow '{iflow_name}' failed ({e}), scanning packages instead.")
+        return None
+    entity = data.get('d') if isinstance(data, dict) else None
+    if not entity or not entity.get('PackageId'):
+        print(f"Direct lookup of iFlow '{iflow_name}' did not return its package, scanning packages instead.")
+        return None
+    return entity
+
+async def scan_for_artifacts(session, base_url, package_url, iflow_names):
+    """Finds iFlows by listing the artifacts of all packages concurrently.
 
-        for package_id in package_ids:
-            template = jinja2.Template(package_url)
-            url = template.render(item=package_id)
+    Package listings run as tasks bounded by SCAN_CONCURRENCY and start while
+    later package pages are still loading. As soon as every requested iFlow
+    has been found, all outstanding listings are cancelled. Returns a dict of
+    listing entries keyed by iFlow Id.
+    """
+    service_root = f"{base_url}/"
+    semaphore = asyncio.Semaphore(scan_concurrency)
+    wanted = set(iflow_names)
+    found = {}
+
+    async def scan_package(package_id):
+        template = jinja2.Template(package_url)
+        url = template.render(item=package_id)
+        async with semaphore:
             try:
-                async with session.get(url) as response:
-                    response.raise_for_status()
-                    data = await response.json()
-                    if 'd' not in data or 'results' not in data['d']:
-                        continue
-                    
-                    for result in data['d']['results']:
-                        if result['Id'] == iflow_name:
-                            # Use specified version or default to active version
-                            iflow_version = version if version != 'active' else result['Version']
-                            
-                            dest_path = os.path.join(base_output_dir, result['PackageId'])
-                            os.makedirs(dest_path, exist_ok=True)
-                            
-                            artifact_template = jinja2.Template(artifacts_url)
-                            artifact_url = artifact_template.render(id=result['Id'], version=iflow_version)
-                            
-                            async with session.get(artifact_url) as artifact_response:
-                                artifact_response.raise_for_status()
-                                content = await artifact_response.read()
-                                
-                                file_path = os.path.join(dest_path, f"{result['Id']}.zip")
-                                with open(file_path, 'wb') as f:
-                                    f.write(content)
-                                
-                                iflow_dir_path = os.path.join(dest_path, result['Id'])
-                                os.makedirs(iflow_dir_path, exist_ok=True)
-                                with zipfile.ZipFile(file_path, 'r') as zip_ref:
-                                    zip_ref.extractall(iflow_dir_path)
-                                
-                                print(f"Successfully downloaded iFlow '{result['Id']}' (version: {iflow_version}) from package '{result['PackageId']}'")
-                                return True
-            except aiohttp.ClientError as e:
+                async with aclosing(iter_entities(session, url, service_root, retry_policy)) as results:
+                    async for result in results:
+                        if result['Id'] in wanted:
+                            found[result['Id']] = result
+                            if wanted <= found.keys():
+                                return
+            except (aiohttp.ClientError, ODataPageError) as e:
                 print(f"Error processing package {package_id}: {e}")
+
+    tasks = set()
+    try:
+        try:
+            async with aclosing(iter_pages(session, f"{base_url}/IntegrationPackages?$format=json", service_root, retry_policy)) as pages:
+                async for packages in pages:
+                    tasks.update(asyncio.create_task(scan_package(package['Id'])) for package in packages)
+                    if wanted <= found.keys():
+                        return found
+        except (aiohttp.ClientError, ODataPageError) as e:
+            print(f"Error fetching packages: {e}")
+
+        while tasks and not wanted <= found.keys():
+            done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        return found
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+async def download_artifact(session, result, iflow_version, artifacts_url, base_output_dir, index=None, recorded_version=None):
+    """Downloads and extracts one artifact into its package directory.
+
+    With an artifact index, size and hash of the zip are recorded in it under
+    `recorded_version`, the concrete version the download resolved to.
+    """
+    dest_path = os.path.join(base_output_dir, result['PackageId'])
+    os.makedirs(dest_path, exist_ok=True)
+    
+    artifact_template = jinja2.Template(artifacts_url)
+    artifact_url = artifact_template.render(id=result['Id'], version=iflow_version)
+    
+    try:
+        async with retry_policy.request(session, 'GET', artifact_url, 'artifact') as artifact_response:
+            artifact_response.raise_for_status()
+            file_path = os.path.join(dest_path, f"{result['Id']}.zip")
+            hasher = hashlib.sha256()
+            await stream_to_file(artifact_response, file_path, chunk_size=download_chunk_size, hasher=hasher)
+    except aiohttp.ClientError as e:
+        print(f"Error downloading iFlow '{result['Id']}': {e}")
+        return False
+    
+    iflow_dir_path = os.path.join(dest_path, result['Id'])
+    await asyncio.to_thread(extract_zip, file_path, iflow_dir_path)
+    if index is not None and recorded_version:
+        await asyncio.to_thread(index.record_download, result['Id'], recorded_version, os.path.getsize(file_path), hasher.hexdigest())
+    
+    print(f"Successfully downloaded iFlow '{result['Id']}' (version: {iflow_version}) from package '{result['PackageId']}'")
+    return True
+
+def parse_iflow_entries(values, default_version):
+    """Turns `Id[:version]` entries (optionally comma separated) into (Id, version) pairs.
+
+    Repeated entries are collapsed. Raises ValueError if an Id is requested in
+    more than one version, since all versions would be written to the same
+    `<Id>.zip` and `<Id>/` directory.
+    """
+    entries = []
+    versions = {}
+    for value in values:
+        for item in value.split(','):
+            item = item.strip()
+            if not item or item.startswith('#'):
                 continue
-                
-    print(f"iFlow '{iflow_name}' not found in any package.")
-    return False
+            iflow_name, _, version = item.partition(':')
+            entry = (iflow_name.strip(), version.strip() or default_version)
+            if versions.setdefault(entry[0], entry[1]) != entry[1]:
+                raise ValueError(f"iFlow '{entry[0]}' is requested in versions '{versions[entry[0]]}' and '{entry[1]}'")
+            if entry not in entries:
+                entries.append(entry)
+    return entries
+
+def read_iflow_file(path):
+    with open(path, 'r') as f:
+        return [line.strip() for line in f]
+
+async def find_and_download_iflows(entries, package_url, artifacts_url, headers, base_output_dir):
+    """Resolves and downloads many iFlows with one session.
+
+    iFlows are resolved from the local artifact index when ARTIFACT_INDEX_PATH
+    is set, then directly; the ones that cannot be are looked up together in
+    a single concurrent package scan. Downloads then run concurrently, bounded
+    by SCAN_CONCURRENCY. Returns True if all succeeded.
+    """
+    base_url = os.environ.get('BASE_URL')
+    semaphore = asyncio.Semaphore(scan_concurrency)
+    artifact_index = ArtifactIndex.from_env(base_url, headers, retry_policy)
+
+    async def bounded(coro):
+        async with semaphore:
+            return await coro
+
+    async def lookup(iflow_name, version):
+        entry = indexed.get(iflow_name)
+        if entry is not None:
+            # The indexed version may be outdated, so the download asks for 'active'
+            return {'Id': entry['Id'], 'PackageId': entry['PackageId'], 'Version': 'active', 'IndexedVersion': entry['Version']}
+        result = await bounded(lookup_artifact(session, base_url, iflow_name, version))
+        if result is not None and artifact_index is not None and version == 'active':
+            await asyncio.to_thread(artifact_index.record, result)
+        return result
+
+    indexed = {}
+    if artifact_index is not None:
+        indexed = await asyncio.to_thread(artifact_index.find_many, [iflow_name for iflow_name, _ in entries])
+
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(ssl=ssl_context), headers=headers) as session:
+        results = await asyncio.gather(*(lookup(iflow_name, version) for iflow_name, version in entries))
+        missing = [iflow_name for (iflow_name, _), result in zip(entries, results) if result is None]
+        scanned = await scan_for_artifacts(session, base_url, package_url, missing) if missing else {}
+
+        downloads = []
+        for (iflow_name, version), result in zip(entries, results):
+            result = result or scanned.get(iflow_name)
+            if result is None:
+                print(f"iFlow '{iflow_name}' not found in any package.")
+                continue
+            # Use specified version or default to active version
+            iflow_version = version if version != 'active' else result['Version']
+            # An index hit is downloaded as 'active'; its size and hash belong to the version the index resolved
+            recorded_version = iflow_version if iflow_version != 'active' else result.get('IndexedVersion')
+            downloads.append(bounded(download_artifact(session, result, iflow_version, artifacts_url, base_output_dir, artifact_index, recorded_version)))
+        succeeded = await asyncio.gather(*downloads)
+
+    if len(entries) > 1:
+        print(f"Downloaded {sum(succeeded)} of {len(entries)} iFlows.")
+    return len(succeeded) == len(entries) and all(succeeded)
+
+async def find_and_download_iflow(iflow_name, version, package_url, artifacts_url, headers, base_output_dir):
+    """Resolves a specific iFlow, directly or by scanning all packages, and downloads it."""
+    return await find_and_download_iflows([(iflow_name, version)], package_url, artifacts_url, headers, base_output_dir)
 
 async def main():
     """Main function to parse arguments and start the download."""
-    parser = argparse.ArgumentParser(description="Download a single iFlow artifact.")
-    parser.add_argument("--iflow", required=True, help="The ID of the iFlow to download.")
-    parser.add_argument("--version", default="active", help="The version of the iFlow to download (default: active).")
-    parser.add_argument("--output_dir", default="./Get_All_Packages", help="The base directory to save the iFlow.")
+    parser = argparse.ArgumentParser(description="Download one or more iFlow artifacts.")
+    parser.add_argument("--iflow", nargs='+', default=[], help="IDs of the iFlows to download, as 'Id' or 'Id:version', separated by spaces or commas.")
+    parser.add_argument("--iflow-file", help="A file with one 'Id' or 'Id:version' entry per line.")
+    parser.add_argument("--version", default="active", help="The version of iFlows given without one (default: active).")
+    parser.add_argument("--output_dir", default="./Get_All_Packages", help="The base directory to save the iFlows.")
     args = parser.parse_args()
 
+    values = list(args.iflow)
+    if args.iflow_file:
+        values.extend(read_iflow_file(args.iflow_file))
+    try:
+        entries = parse_iflow_entries(values, args.version)
+    except ValueError as e:
+        parser.error(str(e))
+    if not entries:
+        parser.error("at least one iFlow is required (--iflow or --iflow-file)")
+
     oauth_url = os.environ.get("OAUTH_URL")
     client_id = os.environ.get("CLIENT_ID")
     client_secret = os.environ.get("CLIENT_SECRET")
@@ -109,11 +251,10 @@ async def main():
     headers = {
         'Content-Type': 'application/json',
         'Accept': 'application/json',
-        'Authorization': f'Bearer {oauth_token}',
-        'X-CSRF-Token': 'fetch'
+        'Authorization': f'Bearer {oauth_token}'
     }
 
-    if not await find_and_download_iflow(args.iflow, args.version, package_url, artifacts_url, headers, args.output_dir):
+    if not await find_and_download_iflows(entries, package_url, artifacts_url, headers, args.output_dir):
         exit(1)
 
 if __name__ == '__main__':
@@ -1,11 +1,18 @@
-import requests
 import os
+import hashlib
 import jinja2
 from jinja2 import Template
 import aiohttp
 import asyncio
 import ssl
-import zipfile
+from contextlib import aclosing
+from download_scheduler import DownloadScheduler
+from artifact_io import ArtifactWriter, LoopLagMonitor
+from artifact_manifest import ArtifactManifest, default_manifest_path
+from cpi_odata import ODataPageError, iter_entities, iter_pages
+from retry_policy import ASYNC_RETRYABLE_ERRORS, RetryPolicy
+from adaptive_concurrency import AimdController
+from oauth_tokens import get_token_provider
 # from dotenv import load_dotenv
 # load_dotenv()
 # Disable SSL certificate verification
@@ -13,71 +20,120 @@ ssl_context = ssl.create_default_context()
 ssl_context.check_hostname = False
 ssl_context.verify_mode = ssl.CERT_NONE
 
-def write_file(file_path, content):
-    lock_file_path = f"{file_path}.lock"
-    with open(lock_file_path, 'w') as f:
-        f.write("lock")
-    with open(file_path, 'wb') as f:
-        f.write(content)
-    os.remove(lock_file_path)
+def create_connection_stats():
+    """Counts new vs reused pooled connections through aiohttp tracing."""
+    stats = {'created': 0, 'reused': 0}
+
+    async def on_connection_create_end(session, context, params):
+        stats['created'] += 1
+
+    async def on_connection_reuseconn(session, context, params):
+        stats['reused'] += 1
+
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_connection_create_end.append(on_connection_create_end)
+    trace_config.on_connection_reuseconn.append(on_connection_reuseconn)
+    return stats, trace_config
+
+def create_session(headers, trace_configs=None):
+    """Creates the single pooled session shared by every package download."""
+    connector = aiohttp.TCPConnector(
+        ssl=ssl_context,
+        limit=pool_limit,
+        limit_per_host=pool_limit_per_host,
+        keepalive_timeout=keepalive_timeout
+    )
+    return aiohttp.ClientSession(connector=connector, headers=headers, trace_configs=trace_configs)
+
 
-def create_package_dir(result, base_output_dir):
-    package_id = result['PackageId']
-    package_dir_path = os.path.join(base_output_dir, package_id)
-    os.makedirs(package_dir_path, exist_ok=True)
-
-def getOAuthToken(oauth_url, client_id, client_secret):
-    payload = {
-        'grant_type': 'client_credentials',
-        'client_id': client_id,
-        'client_secret': client_secret
-    }
-    auth_response = requests.post(oauth_url, data=payload)
-    auth_response.raise_for_status()
-    oauth_token = auth_response.json()['access_token']
-    return oauth_token
 
 
+async def schedule_expanded(scheduler, session, seen, package_url, artifacts_url, base_output_dir, writer, manifest):
+    """Schedules downloads from one expanded, paged listing of packages and their artifacts.
 
-async def fetch_package_ids(base_url, headers):
-    base_url = f"{base_url}/IntegrationPackages"
-    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(ssl=ssl_context), headers=headers) as session:
-        async with session.get(base_url) as response:
-            text = await response.text()
-            if response.status != 200:
-                return []
-            data = await response.json()
-            package_ids = [package['Id'] for package in data['d']['results']]
-            return package_ids
+    Every handled package Id is added to `seen`. Raises ODataPageError if the
+    tenant rejects the $expand or does not inline the artifacts.
+    """
+    url = f"{base_url}/IntegrationPackages?$expand=IntegrationDesigntimeArtifacts&$format=json"
+    async with aclosing(iter_pages(session, url, f"{base_url}/", retry_policy, token_provider=token_provider)) as pages:
+        async for packages in pages:
+            for package in packages:
+                artifacts = package.get('IntegrationDesigntimeArtifacts', {})
+                if 'results' not in artifacts:
+                    raise ODataPageError(url, 200, "artifacts were not inlined")
+                if artifacts.get('__next'):
+                    # The inlined collection is truncated, list this package on its own
+                    await scheduler.submit('listing', download_package, scheduler, session, package['Id'], package_url, artifacts_url, base_output_dir, writer, manifest)
+                else:
+                    await schedule_artifacts(scheduler, session, package['Id'], artifacts['results'], artifacts_url, base_output_dir, writer, manifest)
+                seen.add(package['Id'])
 
 
-async def download_package(package_id, package_url, artifacts_url, headers, base_output_dir):
+async def schedule_per_package(scheduler, session, seen, package_url, artifacts_url, base_output_dir, writer, manifest):
+    """Schedules a listing job for every package not in `seen` as the package pages arrive."""
+    async for package in iter_entities(session, f"{base_url}/IntegrationPackages", f"{base_url}/", retry_policy, token_provider=token_provider):
+        if package['Id'] in seen:
+            continue
+        seen.add(package['Id'])
+        await scheduler.submit('listing', download_package, scheduler, session, package['Id'], package_url, artifacts_url, base_output_dir, writer, manifest)
+
+
+async def schedule_artifacts(scheduler, session, package_id, results, artifacts_url, base_output_dir, writer, manifest, from_job=False):
+    """Queues a download job for every artifact that changed since the last export.
+
+    Listing jobs pass `from_job` so their artifacts are deferred instead of
+    holding the worker until there is queue space.
+    """
+    enqueue = scheduler.defer if from_job else scheduler.submit
+    changed = [result for result in results if full_export or not manifest.is_current(result, base_output_dir)]
+    for result in changed:
+        await enqueue('artifact', download_artifact, session, result, artifacts_url, base_output_dir, writer, manifest)
+    print(f"scheduled {len(changed)} of {len(results)} artifacts for package: {package_id}")
+
+
+async def download_package(scheduler, session, package_id, package_url, artifacts_url, base_output_dir, writer, manifest):
+    """Lists the artifacts of a package and schedules their download."""
     template = jinja2.Template(package_url)
     url = template.render(item=package_id)
-    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(ssl=ssl_context), headers=headers) as session:
-        async with session.get(url) as response:
-            data = await response.json()
-            if 'd' not in data or 'results' not in data['d']:
-                print(f"Unexpected artifacts response for package {package_id}: {data}")
-                return
-            results = data['d']['results']
-            for result in results:
-                create_package_dir(result, base_output_dir)
-                id = result['Id']
-                version = result['Version']
-                template = jinja2.Template(artifacts_url)
-                artifact_url = template.render(id=id, version=version)
-                dest_path = os.path.join(base_output_dir, package_id)
-                filename = f"{id}.zip"
-                file_path = os.path.join(dest_path, filename)
-                async with session.get(artifact_url) as response:
-                    content = await response.content.read()
-                    write_file(file_path, content)
-                    iflow_dir_path = os.path.join(dest_path, id)
-                    os.makedirs(iflow_dir_path, exist_ok=True)
-                    with zipfile.ZipFile(file_path, 'r') as zip_ref:
-                        zip_ref.extractall(iflow_dir_path)
-            print("completed:", package_id)
+    try:
+        async for results in iter_pages(session, url, f"{base_url}/", retry_policy, token_provider=token_provider):
+            await schedule_artifacts(scheduler, session, package_id, results, artifacts_url, base_output_dir, writer, manifest, from_job=True)
+    except ODataPageError as e:
+        print(f"Unexpected artifacts response for package {package_id}: {e}")
+
+
+async def download_artifact(session, result, artifacts_url, base_output_dir, writer, manifest):
+    """Downloads and extracts a single artifact.
+
+    A body that breaks off after the headers arrived is downloaded again
+    from the start, drawing on the same retry budget as failed requests.
+    """
+    id = result['Id']
+    version = result['Version']
+    package_id = result['PackageId']
+    template = jinja2.Template(artifacts_url)
+    artifact_url = template.render(id=id, version=version)
+    dest_path = os.path.join(base_output_dir, package_id)
+    await writer.makedirs(dest_path)
+    filename = f"{id}.zip"
+    file_path = os.path.join(dest_path, filename)
+    attempt = 0
+    while True:
+        hasher = hashlib.sha256()
+        async with retry_policy.request(session, 'GET', artifact_url, 'artifact', token_provider=token_provider) as response:
+            response.raise_for_status()
+            try:
+                await writer.write(response, file_path, hasher)
+                break
+            except ASYNC_RETRYABLE_ERRORS as e:
+                error = e
+        if not await retry_policy.pause_async(attempt, 'artifact', error):
+            raise error
+        attempt += 1
+    iflow_dir_path = os.path.join(dest_path, id)
+    await writer.extract(file_path, iflow_dir_path)
+    manifest.record(result, hasher.hexdigest())
+    print("completed:", f"{package_id}/{id}")
 
 # Load env vars
 oauth_url = os.environ.get("OAUTH_URL")
@@ -87,27 +143,102 @@ base_url = os.environ.get("BASE_URL")
 package_url = os.environ.get("PACKAGE_URL")
 artifacts_url = os.environ.get("ARTIFACTS_URL")
 
+# Connection pool tuning for the shared session
+pool_limit = int(os.environ.get("HTTP_POOL_LIMIT", "100"))
+pool_limit_per_host = int(os.environ.get("HTTP_POOL_LIMIT_PER_HOST", "20"))
+keepalive_timeout = float(os.environ.get("HTTP_KEEPALIVE_TIMEOUT", "30"))
+
+# Download scheduler limits
+download_concurrency = int(os.environ.get("DOWNLOAD_CONCURRENCY", "8"))
+endpoint_concurrency = int(os.environ.get("ENDPOINT_CONCURRENCY", "6"))
+download_queue_size = int(os.environ.get("DOWNLOAD_QUEUE_SIZE", "100"))
+
+# Streaming limits for artifact bodies
+download_chunk_size = int(os.environ.get("DOWNLOAD_CHUNK_SIZE", str(64 * 1024)))
+max_inflight_bytes = int(os.environ.get("MAX_INFLIGHT_BYTES", str(32 * 1024 * 1024)))
+
+# Worker pools for disk writes and zip extraction
+disk_workers = int(os.environ.get("DISK_WORKERS", "4"))
+extract_workers = int(os.environ.get("EXTRACT_WORKERS", "2"))
+extract_in_processes = os.environ.get("EXTRACT_IN_PROCESSES", "false").lower() in ("1", "true", "yes")
+
+# Delta export: artifacts whose listing metadata matches the manifest are skipped
+manifest_path = os.environ.get("MANIFEST_PATH")
+full_export = os.environ.get("FULL_EXPORT", "false").lower() in ("1", "true", "yes")
+
+# 'expand' lists packages with their artifacts in one query, 'per-package' lists each package separately
+listing_mode = os.environ.get("LISTING_MODE", "expand")
+
+# Adaptive concurrency: the scheduler runs between CONCURRENCY_MIN and DOWNLOAD_CONCURRENCY jobs
+adaptive_concurrency = os.environ.get("ADAPTIVE_CONCURRENCY", "true").lower() in ("1", "true", "yes")
+concurrency_controller = AimdController.from_env(download_concurrency) if adaptive_concurrency else None
+
+# Shared retry policy for every request of the run
+retry_policy = RetryPolicy.from_env(controller=concurrency_controller)
+
+# Listings wait for artifact downloads to drain, so one worker must stay free for them
+if download_concurrency < 2:
+    print(f"Error: DOWNLOAD_CONCURRENCY must be at least 2, not {download_concurrency}.")
+    exit(1)
+
 if not all([oauth_url, client_id, client_secret, base_url, package_url, artifacts_url]):
     print("Error: One or more environment variables are not set.")
     exit(1)
 
-oauth_token = getOAuthToken(oauth_url, client_id, client_secret)
+# Tokens are fetched lazily and refreshed before they expire, so long exports never outlive them
+token_provider = get_token_provider(oauth_url, client_id, client_secret, retry_policy)
 
 
 async def main(base_output_dir):
-    tasks = []
     headers = {
         'Content-Type': 'application/json',
-        'Accept': 'application/json',
-        'Authorization': f'Bearer {oauth_token}'
+        'Accept': 'application/json'
     }
-    package_ids = await fetch_package_ids(base_url, headers)
-    if not package_ids:
-        print("No packages found or error fetching package IDs.")
-        return
-    for package_id in package_ids:
-        tasks.append(asyncio.create_task(download_package(package_id, package_url, artifacts_url, headers, base_output_dir)))
-    await asyncio.gather(*tasks)
+    connection_stats, trace_config = create_connection_stats()
+    async with create_session(headers, trace_configs=[trace_config]) as session:
+        scheduler = DownloadScheduler(
+            ['listing', 'artifact'],
+            max_concurrency=download_concurrency,
+            endpoint_concurrency=endpoint_concurrency,
+            queue_size=download_queue_size,
+            controller=concurrency_controller
+        )
+        writer = ArtifactWriter(
+            chunk_size=download_chunk_size,
+            max_inflight_bytes=max_inflight_bytes,
+            disk_workers=disk_workers,
+            extract_workers=extract_workers,
+            extract_in_processes=extract_in_processes
+        )
+        manifest = ArtifactManifest.load(manifest_path or default_manifest_path(base_output_dir))
+        with writer:
+            try:
+                async with LoopLagMonitor() as loop_monitor, scheduler:
+                    seen = set()
+                    listed = False
+                    if listing_mode == 'expand':
+                        try:
+                            await schedule_expanded(scheduler, session, seen, package_url, artifacts_url, base_output_dir, writer, manifest)
+                            listed = True
+                        except ODataPageError as e:
+                            print(f"Expanded package listing failed ({e}), falling back to per-package listings.")
+                    if not listed:
+                        try:
+                            await schedule_per_package(scheduler, session, seen, package_url, artifacts_url, base_output_dir, writer, manifest)
+                        except ODataPageError as e:
+                            print(f"Error fetching packages: {e}")
+                    if not seen:
+                        print("No packages found or error fetching package IDs.")
+                    await scheduler.join()
+            finally:
+                manifest.save()
+        print(f"jobs: {scheduler.completed} completed, {scheduler.failed} failed")
+        print(f"peak in-flight bytes: {writer.budget.peak}")
+        print(loop_monitor.summary())
+        print(retry_policy.summary())
+        if concurrency_controller is not None:
+            print(concurrency_controller.summary())
+    print(f"connections: {connection_stats['created']} created, {connection_stats['reused']} reused")
 
 if __name__ == '__main__':
     output_dir = os.getenv("OUTPUT_DIR", "./Get_All_Packages")
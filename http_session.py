@@ -0,0 +1,32 @@
+import os
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class PooledSession(requests.Session):
+    """requests.Session that keeps connections alive and applies a default timeout."""
+
+    def __init__(self, pool_size=10, timeout=60):
+        super().__init__()
+        self.timeout = timeout
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.mount('https://', adapter)
+        self.mount('http://', adapter)
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return super().request(method, url, **kwargs)
+
+
+def create_session(pool_size=None):
+    """Builds the shared session of a script.
+
+    HTTP_POOL_SIZE sets how many connections per host are kept for reuse
+    (default `pool_size`, or 10), HTTP_TIMEOUT the seconds a request may take
+    when the caller passes no timeout of its own (default 60).
+    """
+    return PooledSession(
+        pool_size=int(os.environ.get("HTTP_POOL_SIZE", str(pool_size or 10))),
+        timeout=float(os.environ.get("HTTP_TIMEOUT", "60"))
+    )
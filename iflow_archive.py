@@ -0,0 +1,189 @@
+import base64
+import hashlib
+import os
+import tempfile
+import threading
+import zipfile
+
+# Zips larger than this spill from memory into an anonymous temp file
+DEFAULT_SPOOL_THRESHOLD = 16 * 1024 * 1024
+
+# Multiple of 3 so the base64 of every chunk can be concatenated without padding
+ENCODE_CHUNK_SIZE = 3 * 64 * 1024
+
+# Every entry gets the same timestamp and permissions, so equal trees give equal zips
+ZIP_TIMESTAMP = (1980, 1, 1, 0, 0, 0)
+FILE_MODE = 0o100644
+DIR_MODE = 0o040755
+
+
+def iter_tree(iflow_path):
+    """Yields (relative_path, path, is_dir) for everything below an iFlow directory.
+
+    Entries come in a fixed order: each directory before its contents, and
+    names sorted within a directory. Relative paths use forward slashes.
+    """
+    for dirpath, dirnames, filenames in os.walk(iflow_path):
+        dirnames.sort()
+        relative_dir = os.path.relpath(dirpath, iflow_path)
+        if relative_dir != os.curdir:
+            yield relative_dir.replace(os.sep, '/'), dirpath, True
+        for filename in sorted(filenames):
+            relative_path = os.path.normpath(os.path.join(relative_dir, filename)).replace(os.sep, '/')
+            yield relative_path, os.path.join(dirpath, filename), False
+
+
+def _zip_info(relative_path, is_dir):
+    info = zipfile.ZipInfo(relative_path + '/' if is_dir else relative_path, date_time=ZIP_TIMESTAMP)
+    info.create_system = 3
+    info.external_attr = (DIR_MODE << 16) | 0x10 if is_dir else FILE_MODE << 16
+    return info
+
+
+def build_zip(iflow_path, spool_threshold=DEFAULT_SPOOL_THRESHOLD, compresslevel=None):
+    """Zips an iFlow directory into a file object positioned at its start.
+
+    The archive has the same entries as `shutil.make_archive(..., root_dir=
+    iflow_path)` but is reproducible: entries are sorted and carry fixed
+    timestamps and permissions, so the same tree always gives the same bytes.
+    It is built in memory, or in an unnamed temp file once it grows beyond
+    `spool_threshold`, so concurrent builds never share a path.
+    `compresslevel` 0 stores entries uncompressed, 1-9 deflates them at that
+    level and None uses the zlib default.
+    """
+    archive = tempfile.SpooledTemporaryFile(max_size=spool_threshold)
+    if compresslevel == 0:
+        options = {'compress_type': zipfile.ZIP_STORED}
+    else:
+        options = {'compress_type': zipfile.ZIP_DEFLATED, 'compresslevel': compresslevel}
+    with zipfile.ZipFile(archive, 'w') as zf:
+        for relative_path, path, is_dir in iter_tree(iflow_path):
+            if is_dir:
+                zf.writestr(_zip_info(relative_path, True), b'')
+            else:
+                with open(path, 'rb') as f:
+                    zf.writestr(_zip_info(relative_path, False), f.read(), **options)
+    archive.seek(0)
+    return archive
+
+
+def encode_base64(fileobj, chunk_size=ENCODE_CHUNK_SIZE):
+    """Base64-encodes a file object chunk by chunk and returns the text."""
+    parts = []
+    while True:
+        chunk = fileobj.read(chunk_size)
+        if not chunk:
+            break
+        parts.append(base64.b64encode(chunk).decode('ascii'))
+    return ''.join(parts)
+
+
+def zip_and_encode(iflow_path, spool_threshold=DEFAULT_SPOOL_THRESHOLD, compresslevel=None):
+    """Returns the base64 text of the zipped iFlow directory."""
+    with build_zip(iflow_path, spool_threshold, compresslevel) as archive:
+        return encode_base64(archive)
+
+
+def tree_hash(iflow_path):
+    """SHA-256 over the relative paths and contents of an iFlow directory.
+
+    Independent of timestamps, permissions and directory listing order, so
+    the same tree always hashes the same on every machine.
+    """
+    digest = hashlib.sha256()
+    for relative_path, path, is_dir in iter_tree(iflow_path):
+        if is_dir:
+            digest.update(b'D' + relative_path.encode('utf-8') + b'\0')
+            continue
+        file_digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(ENCODE_CHUNK_SIZE), b''):
+                file_digest.update(chunk)
+        digest.update(b'F' + relative_path.encode('utf-8') + b'\0' + file_digest.digest())
+    return digest.hexdigest()
+
+
+# The zip cache is trimmed back to this many bytes, oldest entries first
+DEFAULT_CACHE_MAX_BYTES = 1024 * 1024 * 1024
+
+
+def default_cache_dir():
+    """Per-user cache directory, e.g. `~/.cache/cpi_zip_cache`."""
+    return os.path.join(os.path.expanduser('~'), '.cache', 'cpi_zip_cache')
+
+
+def prepare_cache_dir(cache_dir):
+    """Creates the zip cache directory and returns whether it is safe to use.
+
+    Cached payloads are uploaded as they are, so the directory must belong to
+    the current user and must not be writable by anyone else.
+    """
+    try:
+        os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+        st = os.stat(cache_dir)
+    except OSError as e:
+        print(f"Zip cache '{cache_dir}' unavailable, zipping without it: {e}")
+        return False
+    if hasattr(os, 'getuid') and (st.st_uid != os.getuid() or st.st_mode & 0o022):
+        print(f"Zip cache '{cache_dir}' is not private to this user, zipping without it.")
+        return False
+    return True
+
+
+def _write_atomically(path, data):
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def _evict(cache_dir, max_bytes):
+    """Deletes the least recently used cache entries until the cache fits in `max_bytes`."""
+    entries = []
+    with os.scandir(cache_dir) as it:
+        for entry in it:
+            if entry.is_file() and not entry.name.endswith('.tmp'):
+                try:
+                    st = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, entry.path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+
+def cached_zip_and_encode(iflow_path, cache_dir, spool_threshold=DEFAULT_SPOOL_THRESHOLD, compresslevel=None, content_hash=None,
+                          max_bytes=DEFAULT_CACHE_MAX_BYTES):
+    """Like `zip_and_encode`, but reuses the base64 zip of an identical tree from `cache_dir`.
+
+    Entries are keyed on the tree hash and compression level, so an unchanged
+    tree is neither compressed nor encoded again. `content_hash` saves hashing
+    the tree when it is known. After a new entry is written, the least
+    recently used ones are deleted until the cache holds at most `max_bytes`.
+    """
+    level = 'default' if compresslevel is None else compresslevel
+    key = f"{content_hash or tree_hash(iflow_path)}-{level}"
+    encoded_path = os.path.join(cache_dir, f"{key}.b64")
+    try:
+        with open(encoded_path, 'r') as f:
+            encoded = f.read()
+        os.utime(encoded_path)
+        return encoded
+    except FileNotFoundError:
+        pass
+
+    encoded = zip_and_encode(iflow_path, spool_threshold, compresslevel)
+    _write_atomically(encoded_path, encoded.encode('ascii'))
+    _evict(cache_dir, max_bytes)
+    return encoded
@@ -0,0 +1,167 @@
+import asyncio
+import hashlib
+import json
+import os
+import threading
+import time
+
+import requests
+from requests.auth import AuthBase
+
+# Lifetime assumed for tokens whose response carries no expires_in
+DEFAULT_TOKEN_TTL = 300
+
+_providers = {}
+_providers_lock = threading.Lock()
+
+
+class OAuthTokenProvider:
+    """Client-credentials tokens cached in memory and optionally on disk.
+
+    A token is reused until `refresh_margin` seconds before it expires, but
+    for at least half its lifetime, and is then refreshed by the next request
+    that asks for it. Concurrent requesters, threads or coroutines, wait for
+    one shared refresh instead of each fetching their own. With a
+    `cache_path` the token is also shared with later script invocations.
+    """
+
+    def __init__(self, oauth_url, client_id, client_secret, retry_policy=None, cache_path=None, refresh_margin=120):
+        self.oauth_url = oauth_url
+        self.client_id = client_id
+        self.client_secret = client_secret
+        # The token host is not the tenant, so its latency must not steer the tenant's concurrency
+        self.retry_policy = retry_policy.without_controller() if retry_policy else None
+        self.cache_path = cache_path
+        self.refresh_margin = refresh_margin
+        self.cache_key = hashlib.sha256(f"{oauth_url}|{client_id}".encode()).hexdigest()
+        self._token = None
+        self._expires_at = 0.0
+        self._lifetime = DEFAULT_TOKEN_TTL
+        self._lock = threading.Lock()
+        self._async_lock = None
+
+    def _is_fresh(self):
+        # Short-lived tokens would otherwise be due for refresh as soon as they arrive
+        margin = min(self.refresh_margin, self._lifetime / 2)
+        return self._token is not None and time.time() < self._expires_at - margin
+
+    def get_token(self, force_refresh=False):
+        """Returns a valid access token, fetching a new one only when needed."""
+        with self._lock:
+            if force_refresh:
+                self._token = None
+            elif not self._is_fresh():
+                self._load_cached()
+            if not self._is_fresh():
+                self._fetch()
+            return self._token
+
+    async def get_token_async(self, force_refresh=False):
+        if not force_refresh and self._is_fresh():
+            return self._token
+        if self._async_lock is None:
+            self._async_lock = asyncio.Lock()
+        async with self._async_lock:
+            if not force_refresh and self._is_fresh():
+                return self._token
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(None, self.get_token, force_refresh)
+
+    def invalidate(self, token):
+        """Drops `token` after the server rejected it, unless it was already replaced."""
+        with self._lock:
+            if self._token == token:
+                self._token = None
+
+    def _fetch(self):
+        payload = {
+            'grant_type': 'client_credentials',
+            'client_id': self.client_id,
+            'client_secret': self.client_secret
+        }
+
+        def send():
+            return requests.post(self.oauth_url, data=payload, timeout=30)
+
+        auth_response = self.retry_policy.call(send, 'oauth') if self.retry_policy else send()
+        auth_response.raise_for_status()
+        data = auth_response.json()
+        self._token = data['access_token']
+        self._lifetime = float(data.get('expires_in', DEFAULT_TOKEN_TTL))
+        self._expires_at = time.time() + self._lifetime
+        self._store_cached()
+
+    def _load_cached(self):
+        if not self.cache_path or not os.path.exists(self.cache_path):
+            return
+        try:
+            with open(self.cache_path, 'r') as f:
+                entry = json.load(f).get(self.cache_key)
+        except (OSError, ValueError):
+            return
+        if entry:
+            self._token = entry['access_token']
+            self._expires_at = entry['expires_at']
+            self._lifetime = entry.get('lifetime', DEFAULT_TOKEN_TTL)
+
+    def _store_cached(self):
+        if not self.cache_path:
+            return
+        try:
+            entries = {}
+            if os.path.exists(self.cache_path):
+                with open(self.cache_path, 'r') as f:
+                    entries = json.load(f)
+            entries[self.cache_key] = {'access_token': self._token, 'expires_at': self._expires_at, 'lifetime': self._lifetime}
+            tmp_path = f"{self.cache_path}.{os.getpid()}.tmp"
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'w') as f:
+                json.dump(entries, f)
+            os.replace(tmp_path, self.cache_path)
+        except (OSError, ValueError) as e:
+            print(f"Could not write OAuth token cache '{self.cache_path}': {e}")
+
+
+class BearerAuth(AuthBase):
+    """requests auth that sends the provider's current token and retries once on 401."""
+
+    def __init__(self, provider):
+        self.provider = provider
+
+    def __call__(self, request):
+        token = self.provider.get_token()
+        request.headers['Authorization'] = f'Bearer {token}'
+        request.register_hook('response', self._handle_401)
+        request._bearer_token = token
+        return request
+
+    def _handle_401(self, response, **kwargs):
+        if response.status_code != 401 or getattr(response.request, '_bearer_retried', False):
+            return response
+        self.provider.invalidate(getattr(response.request, '_bearer_token', None))
+        response.content
+        response.close()
+        retry = response.request.copy()
+        retry._bearer_retried = True
+        retry.headers['Authorization'] = f'Bearer {self.provider.get_token()}'
+        retried = response.connection.send(retry, **kwargs)
+        retried.history.append(response)
+        retried.request = retry
+        return retried
+
+
+def get_token_provider(oauth_url, client_id, client_secret, retry_policy=None):
+    """Returns the process-wide provider for an OAuth URL and client id.
+
+    Set OAUTH_TOKEN_CACHE to a file path to share tokens across invocations.
+    """
+    key = (oauth_url, client_id)
+    with _providers_lock:
+        if key not in _providers:
+            _providers[key] = OAuthTokenProvider(
+                oauth_url, client_id, client_secret,
+                retry_policy=retry_policy,
+                cache_path=os.environ.get("OAUTH_TOKEN_CACHE"),
+                refresh_margin=float(os.environ.get("OAUTH_REFRESH_MARGIN", "120"))
+            )
+        return _providers[key]
@@ -0,0 +1,147 @@
+import json
+import re
+import uuid
+
+
+class BatchResponse:
+    """Status, headers and body of one request inside an OData `$batch`.
+
+    `changeset_error` marks the single error a changeset of several requests
+    was answered with; it says nothing about the individual request.
+    """
+
+    def __init__(self, status_code, headers, text, changeset_error=False):
+        self.status_code = status_code
+        self.headers = headers
+        self.text = text
+        self.changeset_error = changeset_error
+
+    def json(self):
+        return json.loads(self.text)
+
+
+def _http_part(method, url, body=None):
+    lines = [
+        'Content-Type: application/http',
+        'Content-Transfer-Encoding: binary',
+        '',
+        f'{method} {url} HTTP/1.1',
+        'Accept: application/json'
+    ]
+    if body is not None:
+        payload = json.dumps(body)
+        lines += ['Content-Type: application/json', f'Content-Length: {len(payload.encode("utf-8"))}', '', payload]
+    else:
+        lines += ['', '']
+    return '\r\n'.join(lines)
+
+
+def build_batch(batch_requests, changeset_size=1):
+    """Builds a `$batch` body from (method, url, body) tuples.
+
+    URLs are relative to the service root. Modifying requests are grouped in
+    order into changesets of up to `changeset_size` requests; the tenant
+    applies each changeset atomically. GET requests are sent as standalone
+    retrieve parts. Returns (content_type, body, groups) where `groups` lists
+    the indices of the requests answered by each top-level response part.
+    """
+    boundary = f'batch_{uuid.uuid4()}'
+    parts = []
+    groups = []
+    changeset = []
+
+    def flush():
+        if not changeset:
+            return
+        changeset_boundary = f'changeset_{uuid.uuid4()}'
+        body = ''.join(f'--{changeset_boundary}\r\n{_http_part(*batch_requests[i])}\r\n' for i in changeset)
+        parts.append(f'Content-Type: multipart/mixed; boundary={changeset_boundary}\r\n\r\n{body}--{changeset_boundary}--\r\n')
+        groups.append(list(changeset))
+        changeset.clear()
+
+    for i, (method, url, body) in enumerate(batch_requests):
+        if method == 'GET':
+            flush()
+            parts.append(_http_part(method, url) + '\r\n')
+            groups.append([i])
+            continue
+        changeset.append(i)
+        if len(changeset) >= changeset_size:
+            flush()
+    flush()
+
+    body = ''.join(f'--{boundary}\r\n{part}' for part in parts) + f'--{boundary}--\r\n'
+    return f'multipart/mixed; boundary={boundary}', body.encode('utf-8'), groups
+
+
+def _boundary(content_type):
+    match = re.search(r'boundary="?([^";]+)"?', content_type or '')
+    if not match:
+        raise ValueError(f"No multipart boundary in content type '{content_type}'")
+    return match.group(1)
+
+
+def _split_headers(block):
+    for separator in (b'\r\n\r\n', b'\n\n'):
+        head, found, rest = block.partition(separator)
+        if found:
+            break
+    headers = {}
+    for line in head.decode('utf-8', 'replace').splitlines():
+        name, colon, value = line.partition(':')
+        if colon:
+            headers[name.strip().lower()] = value.strip()
+    return head, headers, rest
+
+
+def _parse_multipart(content_type, body):
+    """Returns the responses of a multipart body; changesets become nested lists."""
+    delimiter = b'--' + _boundary(content_type).encode('utf-8')
+    responses = []
+    for part in body.split(delimiter)[1:]:
+        if part.startswith(b'--'):
+            break
+        part = part.strip(b'\r\n')
+        _, headers, content = _split_headers(part)
+        part_type = headers.get('content-type', '')
+        if part_type.startswith('multipart/mixed'):
+            responses.append(_parse_multipart(part_type, content))
+        else:
+            responses.append(_parse_http(content))
+    return responses
+
+
+def _parse_http(content):
+    head, headers, body = _split_headers(content)
+    status_fields = head.decode('utf-8', 'replace').strip().partition('\n')[0].split()
+    if len(status_fields) < 2 or not status_fields[1].isdigit():
+        raise ValueError(f"Malformed $batch response part: {content[:80]!r}")
+    status_code = int(status_fields[1])
+    return BatchResponse(status_code, headers, body.rstrip(b'\r\n').decode('utf-8', 'replace'))
+
+
+def parse_batch_response(content_type, body, groups):
+    """Maps a `$batch` response back to one BatchResponse per request.
+
+    A changeset that failed is answered with a single error response, which
+    is then reported for every request in it, marked as `changeset_error`
+    if the changeset held more than one request. Raises ValueError if the
+    response cannot be parsed.
+    """
+    parts = _parse_multipart(content_type, body)
+    if len(parts) != len(groups):
+        raise ValueError(f"$batch response has {len(parts)} parts for {len(groups)} request groups")
+    results = [None] * sum(len(group) for group in groups)
+    for group, part in zip(groups, parts):
+        if isinstance(part, list) and len(part) == len(group):
+            answers = part
+        elif isinstance(part, list) and not part:
+            raise ValueError("$batch response has an empty changeset")
+        else:
+            failure = part[0] if isinstance(part, list) else part
+            if len(group) > 1:
+                failure = BatchResponse(failure.status_code, failure.headers, failure.text, changeset_error=True)
+            answers = [failure] * len(group)
+        for i, answer in zip(group, answers):
+            results[i] = answer
+    return results
@@ -0,0 +1,84 @@
+import asyncio
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from urllib.parse import urlparse
+
+
+class TenantRateLimiter:
+    """Token bucket per tenant, shared by every process on this machine.
+
+    The bucket lives in a small SQLite database, so concurrent scripts working
+    against the same tenant draw from one budget of `rate` requests per
+    second with bursts of up to `burst`. Each call reserves a token inside an
+    immediate transaction; when the bucket is empty the reservation pushes it
+    into debt and the caller sleeps until its token has been refilled.
+    """
+
+    def __init__(self, tenant, rate, burst, state_path):
+        self.tenant = tenant
+        self.rate = rate
+        self.burst = burst
+        self.state_path = state_path
+        self.waited = 0.0
+        self._local = threading.local()
+        self._disabled = False
+
+    @classmethod
+    def from_env(cls, tenant_url):
+        """Builds the limiter for the tenant behind `tenant_url`, or None if rate limiting is off."""
+        rate = float(os.environ.get("CPI_RATE_LIMIT", "10"))
+        if rate <= 0 or not tenant_url:
+            return None
+        return cls(
+            tenant=urlparse(tenant_url).netloc or tenant_url,
+            rate=rate,
+            burst=float(os.environ.get("CPI_RATE_BURST", "20")),
+            state_path=os.environ.get("CPI_RATE_STATE", os.path.join(tempfile.gettempdir(), "cpi_rate_limit.sqlite"))
+        )
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.state_path, timeout=30, isolation_level=None)
+            conn.execute("CREATE TABLE IF NOT EXISTS buckets (tenant TEXT PRIMARY KEY, tokens REAL, updated REAL)")
+            self._local.conn = conn
+        return conn
+
+    def _reserve(self):
+        """Takes one token and returns how long the caller has to wait for it."""
+        if self._disabled:
+            return 0.0
+        try:
+            conn = self._connection()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                now = time.time()
+                row = conn.execute("SELECT tokens, updated FROM buckets WHERE tenant = ?", (self.tenant,)).fetchone()
+                tokens = self.burst if row is None else min(self.burst, row[0] + (now - row[1]) * self.rate)
+                tokens -= 1
+                conn.execute("INSERT OR REPLACE INTO buckets (tenant, tokens, updated) VALUES (?, ?, ?)",
+                             (self.tenant, tokens, now))
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        except sqlite3.Error as e:
+            print(f"Rate limiter state '{self.state_path}' unavailable, continuing without it: {e}")
+            self._disabled = True
+            return 0.0
+        return max(-tokens / self.rate, 0.0)
+
+    def acquire(self):
+        wait = self._reserve()
+        if wait > 0:
+            self.waited += wait
+            time.sleep(wait)
+
+    async def acquire_async(self):
+        wait = await asyncio.get_running_loop().run_in_executor(None, self._reserve)
+        if wait > 0:
+            self.waited += wait
+            await asyncio.sleep(wait)
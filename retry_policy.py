@@ -0,0 +1,205 @@
+import asyncio
+import copy
+import os
+import random
+import threading
+import time
+from collections import Counter
+from contextlib import asynccontextmanager
+from email.utils import parsedate_to_datetime
+
+import aiohttp
+import requests
+
+from rate_limiter import TenantRateLimiter
+
+# Statuses that signal throttling or a transient server-side failure
+RETRYABLE_STATUSES = frozenset({429, 500, 502, 503, 504})
+
+SYNC_RETRYABLE_ERRORS = (requests.exceptions.ConnectionError, requests.exceptions.Timeout)
+ASYNC_RETRYABLE_ERRORS = (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, asyncio.TimeoutError)
+
+
+def parse_retry_after(value):
+    """Converts a Retry-After header (delta-seconds or HTTP-date) into seconds."""
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+class RetryPolicy:
+    """Retries idempotent or otherwise safe CPI requests on transient failures.
+
+    Delays grow exponentially from `base_delay` up to `max_delay` with full
+    jitter, and a `Retry-After` header from the server takes precedence (up to
+    `max_retry_after` seconds). All retries of a run draw from one shared
+    `budget` so a tenant outage cannot turn into an endless retry loop.
+    Retries are counted per endpoint for the run summary, and the latency and
+    outcome of every attempt are reported to `controller` (an AimdController)
+    when one is given. Every attempt first draws a token from `rate_limiter`
+    (a TenantRateLimiter), so the whole project stays under the tenant quota.
+    """
+
+    def __init__(self, max_attempts=5, base_delay=0.5, max_delay=30.0, max_retry_after=120.0, budget=100,
+                 controller=None, rate_limiter=None):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_retry_after = max_retry_after
+        self.budget = budget
+        self.controller = controller
+        self.rate_limiter = rate_limiter
+        self.retries = Counter()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls, controller=None):
+        return cls(
+            controller=controller,
+            rate_limiter=TenantRateLimiter.from_env(os.environ.get("BASE_URL")),
+            max_attempts=int(os.environ.get("RETRY_MAX_ATTEMPTS", "5")),
+            base_delay=float(os.environ.get("RETRY_BASE_DELAY", "0.5")),
+            max_delay=float(os.environ.get("RETRY_MAX_DELAY", "30")),
+            max_retry_after=float(os.environ.get("RETRY_MAX_RETRY_AFTER", "120")),
+            budget=int(os.environ.get("RETRY_BUDGET", "100"))
+        )
+
+    def without_controller(self):
+        """A policy with the same settings whose attempts are not reported to the controller.
+
+        For requests to hosts other than the tenant, whose latency and
+        failures say nothing about the tenant's load. Retries are counted in
+        the same summary but draw from a budget of their own.
+        """
+        policy = copy.copy(self)
+        policy.controller = None
+        return policy
+
+    def backoff(self, attempt, retry_after=None):
+        """Returns the delay before retry number `attempt` (starting at 0)."""
+        if retry_after is not None:
+            return min(retry_after, self.max_retry_after)
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+    def _take_retry(self, attempt, endpoint):
+        if attempt + 1 >= self.max_attempts:
+            return False
+        with self._lock:
+            if self.budget <= 0:
+                print(f"Retry budget exhausted, not retrying {endpoint}.")
+                return False
+            self.budget -= 1
+            self.retries[endpoint] += 1
+        return True
+
+    def _record(self, started, failed, endpoint):
+        if self.controller is not None:
+            self.controller.record(time.monotonic() - started, failed, endpoint)
+
+    def _announce(self, endpoint, attempt, delay, reason):
+        print(f"Retrying {endpoint} in {delay:.1f}s (attempt {attempt + 2}/{self.max_attempts}): {reason}")
+
+    def call(self, send, endpoint, statuses=RETRYABLE_STATUSES):
+        """Calls `send()` (returning a requests.Response) until it succeeds or retries run out."""
+        attempt = 0
+        while True:
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire()
+            started = time.monotonic()
+            try:
+                response = send()
+            except SYNC_RETRYABLE_ERRORS as e:
+                self._record(started, True, endpoint)
+                if not self._take_retry(attempt, endpoint):
+                    raise
+                delay = self.backoff(attempt)
+                self._announce(endpoint, attempt, delay, e)
+            else:
+                self._record(started, response.status_code == 429 or response.status_code >= 500, endpoint)
+                if response.status_code not in statuses or not self._take_retry(attempt, endpoint):
+                    return response
+                delay = self.backoff(attempt, parse_retry_after(response.headers.get('Retry-After')))
+                self._announce(endpoint, attempt, delay, f"HTTP {response.status_code}")
+                response.close()
+            time.sleep(delay)
+            attempt += 1
+
+    async def call_async(self, send, endpoint, statuses=RETRYABLE_STATUSES):
+        """Awaits `send()` (returning an aiohttp.ClientResponse) until it succeeds or retries run out."""
+        attempt = 0
+        while True:
+            if self.rate_limiter is not None:
+                await self.rate_limiter.acquire_async()
+            started = time.monotonic()
+            try:
+                response = await send()
+            except ASYNC_RETRYABLE_ERRORS as e:
+                self._record(started, True, endpoint)
+                if not self._take_retry(attempt, endpoint):
+                    raise
+                delay = self.backoff(attempt)
+                self._announce(endpoint, attempt, delay, str(e) or type(e).__name__)
+            else:
+                self._record(started, response.status == 429 or response.status >= 500, endpoint)
+                if response.status not in statuses or not self._take_retry(attempt, endpoint):
+                    return response
+                delay = self.backoff(attempt, parse_retry_after(response.headers.get('Retry-After')))
+                self._announce(endpoint, attempt, delay, f"HTTP {response.status}")
+                response.release()
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def pause_async(self, attempt, endpoint, error):
+        """Waits out the backoff before retry number `attempt` of work the caller repeats itself.
+
+        The failure is reported to the controller like a failed request.
+        Returns False, without waiting, when no retry is left.
+        """
+        self._record(time.monotonic(), True, endpoint)
+        if not self._take_retry(attempt, endpoint):
+            return False
+        delay = self.backoff(attempt)
+        self._announce(endpoint, attempt, delay, str(error) or type(error).__name__)
+        await asyncio.sleep(delay)
+        return True
+
+    @asynccontextmanager
+    async def request(self, session, method, url, endpoint, token_provider=None, **kwargs):
+        """Retrying counterpart of `async with session.request(...) as response`.
+
+        With a `token_provider` every attempt carries its current bearer token,
+        and a 401 is answered once with a freshly fetched token.
+        """
+        async def send():
+            if token_provider is None:
+                return await session.request(method, url, **kwargs)
+            token = await token_provider.get_token_async()
+            for retried in (False, True):
+                headers = dict(kwargs.get('headers') or {}, Authorization=f'Bearer {token}')
+                response = await session.request(method, url, **dict(kwargs, headers=headers))
+                if response.status != 401 or retried:
+                    return response
+                response.release()
+                token_provider.invalidate(token)
+                token = await token_provider.get_token_async()
+
+        response = await self.call_async(send, endpoint)
+        try:
+            yield response
+        finally:
+            response.release()
+
+    def summary(self):
+        total = sum(self.retries.values())
+        per_endpoint = ", ".join(f"{endpoint}={count}" for endpoint, count in sorted(self.retries.items()))
+        summary = f"retries: {total}" + (f" ({per_endpoint})" if per_endpoint else "") + f", budget left {self.budget}"
+        if self.rate_limiter is not None:
+            summary += f", rate limit wait {self.rate_limiter.waited:.1f}s"
+        return summary
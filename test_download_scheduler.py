@@ -0,0 +1,53 @@
+import asyncio
+import unittest
+
+from download_scheduler import DownloadScheduler
+
+
+class FixedLimit:
+    def __init__(self, limit):
+        self.limit = limit
+
+
+async def run_listings(listings, artifacts, limit, max_concurrency=8, queue_size=100):
+    """Runs listing jobs that each defer `artifacts` artifact jobs and returns the scheduler."""
+    scheduler = DownloadScheduler(['listing', 'artifact'], max_concurrency=max_concurrency,
+                                  queue_size=queue_size, controller=FixedLimit(limit))
+
+    async def artifact():
+        await asyncio.sleep(0)
+
+    async def listing():
+        await asyncio.sleep(0)
+        for _ in range(artifacts):
+            await scheduler.defer('artifact', artifact)
+
+    async with scheduler:
+        for _ in range(listings):
+            await scheduler.submit('listing', listing)
+        await asyncio.wait_for(scheduler.join(), timeout=30)
+    return scheduler
+
+
+class DownloadSchedulerTest(unittest.TestCase):
+
+    def test_deferring_jobs_finish_at_lowest_limit(self):
+        scheduler = asyncio.run(run_listings(50, 60, limit=1))
+        self.assertEqual(scheduler.completed, 50 + 50 * 60)
+        self.assertEqual(scheduler.failed, 0)
+
+    def test_deferring_jobs_finish_at_small_limit(self):
+        scheduler = asyncio.run(run_listings(50, 200, limit=2))
+        self.assertEqual(scheduler.completed, 50 + 50 * 200)
+
+    def test_two_workers_are_enough(self):
+        scheduler = asyncio.run(run_listings(5, 100, limit=1, max_concurrency=2))
+        self.assertEqual(scheduler.completed, 5 + 5 * 100)
+
+    def test_single_worker_is_rejected_with_several_endpoints(self):
+        with self.assertRaises(ValueError):
+            DownloadScheduler(['listing', 'artifact'], max_concurrency=1)
+
+
+if __name__ == '__main__':
+    unittest.main()